@@ -4,19 +4,44 @@ module_path = os.path.abspath("..")
 if module_path not in sys.path:
     sys.path.append(module_path)
 
-import pandas as pd
-import dionysus as d
+import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.preprocessing import StandardScaler
-from src.tda import ClutchMapper
-from src.data_pipeline import query_avg, query_week
 
 plt.style.use('ggplot')
 
 positions = ['QB', 'RB', 'WR', 'TE', 'K', 'DEF', 'LB', 'DB', 'DL']
 n_sets = [5, 12, 12, 11, 8, 7, 11, 7, 10]
 
+def plot_bars(diagram, ax=None, **bar_style):
+    '''
+    This function plots a barcode diagram the same way dionysus.plot.plot_bars
+    does, from an array of births and deaths such as the ones returned by 
+    ClutchMapper.zero_persistence
+
+    PARAMETERS
+    ----------
+    diagram: {array} a (m, 2) array of the birth and death of each bar
+
+    ax: {matplotlib.axes.Axes} the axes to plot on, defaults to the current 
+        axes
+
+    bar_style: keyword arguments passed to matplotlib for each bar
+    '''
+    bar_kwargs = {'color': 'b'}
+    bar_kwargs.update(bar_style)
+
+    if ax is None:
+        ax = plt.gca()
+
+    # Bars that never die run to the end of the plot
+    finite = diagram[np.isfinite(diagram)]
+    end = finite.max() * 1.1 if finite.shape[0] > 0 else 1.
+
+    for i, (birth, death) in enumerate(diagram):
+        ax.plot([birth, min(death, end)], [i, i], **bar_kwargs)
+
+    return ax
+
 # for n, pos in zip(n_sets, positions):
 #     for week in range(1,18):
 #         df = query_week(week=week, pos=pos)
@@ -34,18 +59,12 @@ n_sets = [5, 12, 12, 11, 8, 7, 11, 7, 10]
 #         cmapper = ClutchMapper()
 #         cmapper.fit(scaled_stats, labels)
 
-#         observer_f, landmark_f = cmapper.build_filtrations()
-
-#         observer_ph = d.homology_persistence(observer_f)
-#         landmark_ph = d.homology_persistence(landmark_f)
-
-#         observer_dgms = d.init_diagrams(observer_ph, observer_f)
-#         landmark_dgms = d.init_diagrams(landmark_ph, landmark_f)
+#         observer_dgm, landmark_dgm = cmapper.zero_persistence()
 
 #         observer_barcode = plt.figure(figsize=(15,10))
 #         observer_barcode_title = "2017 {} Week {}: Barcode Diagram for $\\beta_0$ of the Observer Complex".format(pos,week)
 #         plt.title(observer_barcode_title)
-#         d.plot.plot_bars(observer_dgms[0])
+#         plot_bars(observer_dgm)
 #         observer_barcode_filepath="plots/week{}/{}_barcode_observer.png".format(week,pos.lower())
 #         observer_barcode.savefig(observer_barcode_filepath)
 #         plt.close(observer_barcode)
@@ -54,53 +73,18 @@ n_sets = [5, 12, 12, 11, 8, 7, 11, 7, 10]
 #         landmark_barcode = plt.figure(figsize=(15,10))
 #         landmark_barcode_title="2017 {} Week {}: Barcode Diagram for $\\beta_0$ of the Landmark Complex".format(pos,week)
 #         plt.title(landmark_barcode_title)
-#         d.plot.plot_bars(landmark_dgms[0])
+#         plot_bars(landmark_dgm)
 #         landmark_barcode_filepath="plots/week{}/{}_barcode_landmark.png".format(week,pos.lower())
 #         landmark_barcode.savefig(landmark_barcode_filepath)
 #         plt.close(landmark_barcode)
 #         print("Saved {} to {}".format(landmark_barcode_title, landmark_barcode_filepath))
 
 
-for n, pos in zip(n_sets, positions):
-    df = query_week(week=1, pos=pos)
-    df = df.iloc[:100]
-    names = list(df['name'].values)
-    X = df['weekpts'].values.reshape(-1,1)
-    agg = AgglomerativeClustering(n_clusters=n, linkage='ward')
-    labels = agg.fit_predict(X)
-
-    stats = df.iloc[:,4:].values
-
-    scaler = StandardScaler()
-    scaled_stats = scaler.fit_transform(stats)
-
-    cmapper = ClutchMapper()
-    cmapper.fit(scaled_stats, labels)
-
-    observer_f, landmark_f = cmapper.build_filtrations()
-
-    observer_ph = d.homology_persistence(observer_f)
-    landmark_ph = d.homology_persistence(landmark_f)
-
-    observer_dgms = d.init_diagrams(observer_ph, observer_f)
-    landmark_dgms = d.init_diagrams(landmark_ph, landmark_f)
-
-    observer_barcode = plt.figure(figsize=(15,10))
-    observer_barcode_title = "2018 {} Week 1: Barcode Diagram for $\\beta_0$ of the Observer Complex".format(pos)
-    plt.title(observer_barcode_title)
-    d.plot.plot_bars(observer_dgms[0])
-    observer_barcode_filepath="plots/2018/week1/{}_barcode_observer.png".format(pos.lower())
-    observer_barcode.savefig(observer_barcode_filepath)
-    plt.close(observer_barcode)
-    print("Saved {} to {}".format(observer_barcode_title, observer_barcode_filepath))
-
-    landmark_barcode = plt.figure(figsize=(15,10))
-    landmark_barcode_title="2018 {} Week 1: Barcode Diagram for $\\beta_0$ of the Landmark Complex".format(pos)
-    plt.title(landmark_barcode_title)
-    d.plot.plot_bars(landmark_dgms[0])
-    landmark_barcode_filepath="plots/2018/week1/{}_barcode_landmark.png".format(pos.lower())
-    landmark_barcode.savefig(landmark_barcode_filepath)
-    plt.close(landmark_barcode)
-    print("Saved {} to {}".format(landmark_barcode_title, landmark_barcode_filepath))
+if __name__ == '__main__':
+    from src.pipeline import Job, PipelineRunner
 
+    # Plot the week 1 data the baseline script queried, query_week's default
+    # 2017 season, titled and saved under the year it actually is
+    jobs = [Job(2017, 1, pos) for pos in positions]
 
+    PipelineRunner(jobs, stage='barcodes').run()
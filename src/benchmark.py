@@ -0,0 +1,450 @@
+import os
+import sys
+module_path = os.path.abspath(os.path.join('..'))
+if module_path not in sys.path:
+    sys.path.append(module_path)
+import argparse
+import json
+import subprocess
+import tracemalloc
+from itertools import product
+from time import perf_counter, strftime
+import numpy as np
+from scipy.special import comb
+from src.tda import ClutchMapper, visualize_complex
+from src.makeitfaster import FasterClutchMapper
+
+LANDMARKS = [50, 100, 500, 1000, 5000]
+OBSERVERS = [5, 12, 50]
+FEATURES = [10, 60, 93]
+# Thresholds are quantiles of the observer-landmark distances so that they
+# mean the same thing at every feature dimension
+QUANTILES = [0.01, 0.05, 0.1]
+
+# Stages are skipped when they would build more simplices than this
+MAX_SIMPLICES = 5 * 10**6
+MAX_VISUALIZE_SIMPLICES = 10**5
+
+# Players on a synthetic rotoguru page, about as many as a real week
+ROTOGURU_PLAYERS = 1000
+
+# CLUTCH_BENCHMARK is where the results are saved
+BENCHMARK_PATH = os.environ.get('CLUTCH_BENCHMARK',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.cache', 'clutch',
+                                             'benchmark.json'))
+
+# Keys of a result that are measured rather than configured
+MEASURES = {'seconds', 'peak_bytes', 'n_simplices', 'n_rows', 'skipped'}
+
+def synthetic_data(n_landmarks, n_observers, n_features, seed=0):
+    '''
+    This function generates a point cloud shaped like the scaled fantasy stats,
+    with overlapping gaussian clusters standing in for the fantasy point groups
+
+    PARAMETERS
+    ----------
+    n_landmarks: {int} the number of points
+
+    n_observers: {int} the number of clusters
+
+    n_features: {int} the number of stats
+
+    seed: {int} the random seed
+
+    RETURNS
+    -------
+    data: {array} (n_landmarks, n_features) array of points
+
+    labels: {array} the cluster of each point
+    '''
+    rng = np.random.RandomState(seed)
+    labels = rng.permutation(np.arange(n_landmarks) % n_observers)
+    centers = rng.normal(scale=2., size=(n_observers, n_features))
+    data = centers[labels] + rng.normal(size=(n_landmarks, n_features))
+
+    return data, labels
+
+def _estimate_simplices(distances, p, k=2):
+    '''
+    This function bounds the number of simplices of the landmark complex at a
+    visibility threshold by the number each observer witnesses
+
+    PARAMETERS
+    ----------
+    distances: {array} (observers, landmarks) array of distances
+
+    p: {float} the visibility threshold
+
+    k: {int} the highest dimension of the simplices
+
+    RETURNS
+    -------
+    n_simplices: {float} the bound
+    '''
+    seen = (distances < p).sum(axis=1)
+    return sum(comb(seen, r).sum() for r in range(1, k+2))
+
+def _measure(stage, repeats=1):
+    '''
+    This function runs a stage and measures its fastest time and its peak
+    memory
+
+    PARAMETERS
+    ----------
+    stage: {function} a function without arguments
+
+    repeats: {int} the number of times to time the stage
+
+    RETURNS
+    -------
+    result: the return value of the stage
+
+    seconds: {float} the fastest time
+
+    peak_bytes: {int} the peak memory allocated while the stage ran
+    '''
+    tracemalloc.start()
+    result = stage()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    seconds = np.inf
+    for i in range(repeats):
+        start = perf_counter()
+        stage()
+        seconds = min(seconds, perf_counter() - start)
+
+    return result, seconds, peak_bytes
+
+def run_benchmarks(landmarks=LANDMARKS, observers=OBSERVERS, features=FEATURES,
+                   quantiles=QUANTILES, repeats=1, verbose=True):
+    '''
+    This function times ClutchMapper.fit, build_complex, build_filtrations,
+    FasterClutchMapper.fit and visualize_complex on synthetic point clouds,
+    sweeping the number of landmarks, observers, features and the threshold
+
+    PARAMETERS
+    ----------
+    landmarks: {list} the numbers of landmarks
+
+    observers: {list} the numbers of observers
+
+    features: {list} the feature dimensions
+
+    quantiles: {list} the thresholds, as quantiles of the distances
+
+    repeats: {int} the number of times to time each stage
+
+    verbose: {bool} whether to print each result
+
+    RETURNS
+    -------
+    results: {list} a dict for each stage and configuration
+    '''
+    results = []
+
+    def record(stage, config, seconds=None, peak_bytes=None, n_simplices=None,
+               skipped=None):
+        result = dict(config, stage=stage, seconds=seconds,
+                      peak_bytes=peak_bytes, n_simplices=n_simplices)
+        if skipped is not None:
+            result['skipped'] = skipped
+        results.append(result)
+
+        if verbose:
+            print(json.dumps(result, sort_keys=True))
+
+    for n_landmarks, n_observers, n_features in \
+            product(landmarks, observers, features):
+        if n_observers > n_landmarks:
+            continue
+
+        config = {'n_landmarks': n_landmarks, 'n_observers': n_observers,
+                  'n_features': n_features, 'quantile': None}
+        data, labels = synthetic_data(n_landmarks, n_observers, n_features)
+
+        def fit():
+            cmapper = ClutchMapper()
+            cmapper.fit(data, labels)
+            return cmapper
+
+        cmapper, seconds, peak_bytes = _measure(fit, repeats)
+        record('ClutchMapper.fit', config, seconds, peak_bytes)
+
+        # FasterClutchMapper always builds the filtrations up to the maximum
+        # visibility, where every combination of landmarks is a simplex
+        full_size = sum(comb(n_landmarks, r) for r in range(1, 4))
+        if full_size > MAX_SIMPLICES:
+            record('FasterClutchMapper.fit', config,
+                   skipped='{:.0f} simplices'.format(full_size))
+        else:
+            def faster_fit():
+                faster_cmapper = FasterClutchMapper()
+                faster_cmapper.fit(data, labels)
+                return faster_cmapper
+
+            faster_cmapper, seconds, peak_bytes = _measure(faster_fit, repeats)
+            record('FasterClutchMapper.fit', config, seconds, peak_bytes,
+                   len(faster_cmapper.landmark_filtration_))
+
+        for quantile in quantiles:
+            config['quantile'] = quantile
+            p = np.percentile(cmapper.distances_, 100 * quantile)
+
+            estimate = _estimate_simplices(cmapper.distances_, p)
+            if estimate > MAX_SIMPLICES:
+                for stage in ['ClutchMapper.build_complex',
+                              'ClutchMapper.build_filtrations',
+                              'visualize_complex']:
+                    record(stage, config,
+                           skipped='{:.0f} simplices'.format(estimate))
+                continue
+
+            complexes, seconds, peak_bytes = \
+                _measure(lambda: cmapper.build_complex(p), repeats)
+            landmark_complex = complexes[1]
+            record('ClutchMapper.build_complex', config, seconds, peak_bytes,
+                   len(landmark_complex))
+
+            filtrations, seconds, peak_bytes = \
+                _measure(lambda: cmapper.build_filtrations(end=p), repeats)
+            record('ClutchMapper.build_filtrations', config, seconds,
+                   peak_bytes, len(filtrations[1]))
+
+            if len(landmark_complex) > MAX_VISUALIZE_SIMPLICES:
+                record('visualize_complex', config,
+                       skipped='{} simplices'.format(len(landmark_complex)))
+            elif len(landmark_complex.vertices) == 0:
+                record('visualize_complex', config, skipped='empty complex')
+            else:
+                fig, seconds, peak_bytes = \
+                    _measure(lambda: visualize_complex(landmark_complex),
+                             repeats)
+                record('visualize_complex', config, seconds, peak_bytes,
+                       len(landmark_complex))
+
+    return results
+
+def rotoguru_page(n_players=ROTOGURU_PLAYERS, seed=0):
+    '''
+    This function generates a page shaped like a rotoguru DraftKings page,
+    with the semi-colon separated data in a <pre> block between the markup
+
+    PARAMETERS
+    ----------
+    n_players: {int} the number of rows
+
+    seed: {int} the random seed
+
+    RETURNS
+    -------
+    html_str: {str} the html of the page
+    '''
+    rng = np.random.RandomState(seed)
+    positions = ['QB', 'RB', 'WR', 'TE', 'Def']
+    rows = ['Week;Year;GID;Name;Pos;Team;h/a;Oppt;DK points;DK salary']
+    for i in range(n_players):
+        rows.append('1;2017;{};Player{}, First{};{};tm{};{};op{};{:.2f};{}'.\
+                        format(i, i, i, positions[i % len(positions)],
+                               i % 32, 'ah'[i % 2], (i + 1) % 32,
+                               rng.uniform(-2, 40),
+                               rng.randint(30, 100) * 100))
+
+    markup = '<table>' + '<tr><td><a href="#">link</a></td></tr>' * 500 + \
+             '</table>'
+
+    return '<html><head><title>DraftKings</title></head><body>' + markup + \
+           '<pre>' + '\n'.join(rows) + '\n</pre>' + markup + '</body></html>'
+
+def record_rotoguru_pages(weeks, directory):
+    '''
+    This function saves rotoguru pages to disk so the parser can be
+    benchmarked on real pages without the network
+
+    PARAMETERS
+    ----------
+    weeks: {list} (week, year) tuples
+
+    directory: {str} where to save the pages
+
+    RETURNS
+    -------
+    paths: {list} the path of each page that was retrieved
+    '''
+    from src.data_pipeline import _fetch_rotoguru_page
+    from src.scraping import get_client
+
+    os.makedirs(directory, exist_ok=True)
+    pages, errors = get_client().map(_fetch_rotoguru_page, weeks)
+
+    paths = []
+    for (week, year), html_str in sorted(pages.items()):
+        path = os.path.join(directory,
+                            'rotoguru_{}_week{}.html'.format(year, week))
+        with open(path, 'w') as f:
+            f.write(html_str)
+        paths.append(path)
+
+    return paths
+
+def run_parser_benchmarks(paths=None, repeats=1, verbose=True):
+    '''
+    This function times extracting the data out of rotoguru pages and parsing
+    it into a DataFrame, next to extracting it with BeautifulSoup
+
+    PARAMETERS
+    ----------
+    paths: {list} recorded pages, or None for a synthetic page
+
+    repeats: {int} the number of times to time each stage
+
+    verbose: {bool} whether to print each result
+
+    RETURNS
+    -------
+    results: {list} a dict for each stage and page
+    '''
+    from src.data_pipeline import _extract_pre, _parse_rotoguru
+
+    if paths:
+        pages = []
+        for path in paths:
+            with open(path) as f:
+                pages.append((os.path.basename(path), f.read()))
+    else:
+        pages = [('synthetic', rotoguru_page())]
+
+    def beautiful_soup(html_str):
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(html_str, 'html.parser').find('pre').getText()
+
+    stages = [('BeautifulSoup', beautiful_soup),
+              ('_extract_pre', _extract_pre),
+              ('_parse_rotoguru', _parse_rotoguru)]
+
+    results = []
+    for page, html_str in pages:
+        for stage, parse in stages:
+            result = {'stage': stage, 'page': page}
+            try:
+                df, seconds, peak_bytes = \
+                    _measure(lambda: parse(html_str), repeats)
+            except ImportError as e:
+                result['skipped'] = str(e)
+            else:
+                result.update(seconds=seconds, peak_bytes=peak_bytes)
+                if stage == '_parse_rotoguru':
+                    result['n_rows'] = len(df)
+            results.append(result)
+
+            if verbose:
+                print(json.dumps(result, sort_keys=True))
+
+    return results
+
+def _result_key(result):
+    return tuple(sorted((key, value) for key, value in result.items()
+                        if key not in MEASURES))
+
+def compare(baseline, results, tolerance=0.25, min_seconds=0.01):
+    '''
+    This function flags the stages that got slower or used more memory than in
+    a baseline run by more than the tolerance
+
+    PARAMETERS
+    ----------
+    baseline: {list} results of a previous run
+
+    results: {list} results of the current run
+
+    tolerance: {float} the allowed relative increase
+
+    min_seconds: {float} stages faster than this in both runs are too noisy to
+                 compare times
+
+    RETURNS
+    -------
+    regressions: {list} a dict for each regression
+    '''
+    previous = {_result_key(result): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        before = previous.get(_result_key(result))
+        if before is None or before.get('seconds') is None or \
+                result.get('seconds') is None:
+            continue
+
+        for measure in ['seconds', 'peak_bytes']:
+            if measure == 'seconds' and \
+                    max(before['seconds'], result['seconds']) < min_seconds:
+                continue
+            if result[measure] > before[measure] * (1 + tolerance):
+                regressions.append(dict(result, measure=measure,
+                                        baseline=before[measure],
+                                        ratio=result[measure]/before[measure]))
+
+    return regressions
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                   stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the TDA hot paths on synthetic point clouds '
+                    'and the rotoguru parser on recorded pages')
+    parser.add_argument('--landmarks', type=int, nargs='+', default=LANDMARKS)
+    parser.add_argument('--observers', type=int, nargs='+', default=OBSERVERS)
+    parser.add_argument('--features', type=int, nargs='+', default=FEATURES)
+    parser.add_argument('--quantiles', type=float, nargs='+', default=QUANTILES)
+    parser.add_argument('--rotoguru-pages', nargs='+',
+                        help='recorded rotoguru pages to parse, defaults to '
+                             'a synthetic page')
+    parser.add_argument('--suite', choices=['tda', 'parser', 'all'],
+                        default='all', help='which benchmarks to run')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=BENCHMARK_PATH,
+                        help='where to save the results, defaults to the '
+                             'CLUTCH_BENCHMARK environment variable or '
+                             '~/.cache/clutch/benchmark.json')
+    parser.add_argument('--baseline',
+                        help='results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the allowed relative slowdown')
+    args = parser.parse_args()
+
+    results = []
+    if args.suite in ['tda', 'all']:
+        results += run_benchmarks(args.landmarks, args.observers,
+                                  args.features, args.quantiles, args.repeats)
+    if args.suite in ['parser', 'all']:
+        results += run_parser_benchmarks(args.rotoguru_pages, args.repeats)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'commit': _git_commit(),
+                   'created': strftime('%Y-%m-%d %H:%M:%S'),
+                   'results': results}, f, indent=2)
+    print("Saved {} results to {}".format(len(results), args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            config = ', '.join('{}={}'.format(key, value)
+                               for key, value in _result_key(regression)
+                               if key not in ['stage', 'measure', 'baseline',
+                                              'ratio'])
+            print("Regression in {} ({}) for {}: {:.2f}x".format(
+                      regression['stage'], regression['measure'], config,
+                      regression['ratio']))
+
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,206 @@
+import os
+import sys
+module_path = os.path.abspath(os.path.join('..'))
+if module_path not in sys.path:
+    sys.path.append(module_path)
+import hashlib
+import tempfile
+import numpy as np
+from src.tda import ClutchMapper
+
+CACHE_DIR = os.environ.get('CLUTCH_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache',
+                                        'clutch'))
+
+# The modules whose source decides what a fitted ClutchMapper looks like, so
+# editing any of them invalidates the cache
+SOURCES = ['tda.py', 'simplicial.py']
+
+def code_version():
+    '''
+    This function hashes the source of the modules that fit a ClutchMapper
+
+    RETURNS
+    -------
+    version: {str} the hex digest of the source
+    '''
+    digest = hashlib.sha1()
+    for source in SOURCES:
+        with open(os.path.join(os.path.dirname(__file__), source), 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+class ClutchMapperCache:
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=2**30):
+        '''
+        The ClutchMapperCache object saves the fitted cover, distances and
+        filtrations of a ClutchMapper to compressed .npz files, keyed by a hash
+        of the data, labels, metric and code version. Fitting the same data
+        again loads them instead of redoing the math. When the files grow past
+        max_bytes the least recently used ones are removed.
+
+        PARAMETERS
+        ----------
+        directory: {str} where to save the files, defaults to the CLUTCH_CACHE
+                   environment variable or ~/.cache/clutch
+
+        max_bytes: {int} the size cap of the cache
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, data, labels, metric='euclidean'):
+        '''
+        This method hashes everything a fitted ClutchMapper depends on
+
+        PARAMETERS
+        ----------
+        data: {array} point cloud data that become the landmarks
+
+        labels: {array} labels from clustering the data in a reduced
+                dimensionality that become the observers
+
+        metric: {str} the distance metric
+
+        RETURNS
+        -------
+        key: {str} the hex digest
+        '''
+        digest = hashlib.sha1()
+        for array in [np.ascontiguousarray(data, dtype=float),
+                      np.ascontiguousarray(labels, dtype=np.int64)]:
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        digest.update(metric.encode())
+        digest.update(self.version.encode())
+
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, data, labels, metric='euclidean'):
+        '''
+        This method loads a fitted ClutchMapper from the cache
+
+        PARAMETERS
+        ----------
+        data: {array} point cloud data that become the landmarks
+
+        labels: {array} labels from clustering the data in a reduced
+                dimensionality that become the observers
+
+        metric: {str} the distance metric
+
+        RETURNS
+        -------
+        cmapper: {ClutchMapper} or None if the data has not been cached
+        '''
+        path = self._path(self.key(data, labels, metric))
+
+        try:
+            with np.load(path) as arrays:
+                arrays = dict(arrays)
+        except (IOError, ValueError):
+            return None
+
+        # Mark the file as recently used
+        os.utime(path, None)
+
+        return ClutchMapper.from_arrays(data, labels, arrays, metric)
+
+    def store(self, cmapper):
+        '''
+        This method saves a fitted ClutchMapper to the cache and then evicts the
+        least recently used files past the size cap
+
+        PARAMETERS
+        ----------
+        cmapper: {ClutchMapper} a fitted ClutchMapper
+        '''
+        path = self._path(self.key(cmapper.landmarks_, cmapper.labels,
+                                   cmapper.metric))
+
+        # Write to a temporary file first so that readers never see a partial
+        # file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **cmapper.to_arrays())
+        os.replace(tmp_path, path)
+
+        self._evict()
+
+    def _evict(self):
+        '''
+        This method removes the least recently used files until the cache is
+        under its size cap
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def fit(self, data, labels, metric='euclidean', filtrations=True, k=2,
+            end=None):
+        '''
+        This method returns a fitted ClutchMapper, loading it from the cache
+        when possible and fitting and caching it otherwise
+
+        PARAMETERS
+        ----------
+        data: {array} point cloud data that become the landmarks
+
+        labels: {array} labels from clustering the data in a reduced
+                dimensionality that become the observers
+
+        metric: {str} the distance metric
+
+        filtrations: {bool} whether to build the filtrations as well
+
+        k: {int} specifify up to which dimension k-complex to calculate
+
+        end: {float} the largest visibility threshold of the filtrations,
+             defaults to the maximum visibility
+
+        RETURNS
+        -------
+        cmapper: {ClutchMapper}
+        '''
+        cmapper = self.load(data, labels, metric)
+
+        if cmapper is None:
+            cmapper = ClutchMapper(metric)
+            cmapper.fit(data, labels)
+        elif not filtrations or self._has_filtrations(cmapper, k, end):
+            return cmapper
+
+        if filtrations:
+            cmapper.build_filtrations(end, k)
+        self.store(cmapper)
+
+        return cmapper
+
+    def _has_filtrations(self, cmapper, k, end):
+        if not hasattr(cmapper, 'filtration_params_'):
+            return False
+
+        cached_k, cached_end = cmapper.filtration_params_
+        if end is None:
+            end = cmapper.distances_.max()
+
+        return cached_k == k and cached_end >= end
@@ -1,18 +1,39 @@
 import os
-import requests
-from bs4 import BeautifulSoup
+import sys
+module_path = os.path.abspath(os.path.join('..'))
+if module_path not in sys.path:
+    sys.path.append(module_path)
 import io
+import re
+import html
+import json
 import pandas as pd
 import numpy as np
-import psycopg2
-from sqlalchemy import create_engine
-
-engine = create_engine("postgresql+psycopg2://{}:{}@{}/nfl"\
-            .format(os.environ['CLUTCH_USR'],
-                    os.environ['CLUTCH_PWD'],
-                    os.environ['AWS_RDS']))
-
-def rotoguru_scrape(week=1, year=2017):
+from src.scraping import get_client
+from src.storage import get_backend, PostgresBackend
+from src.query_cache import get_query_cache
+from src import metrics
+
+# The stat names are cached in a file shipped with the package, so importing
+# this module never needs the network
+STAT_NAMES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'stat_names.json')
+STAT_NAMES_VERSION = 1
+
+# The base urls can be pointed elsewhere, e.g. at a local stub server
+ROTOGURU_URL = os.environ.get('ROTOGURU_URL',
+                              'http://rotoguru1.com/cgi-bin/fyday.pl')
+FANTASY_API_URL = os.environ.get('FANTASY_API_URL',
+                                 'http://api.fantasy.nfl.com/v1')
+STAT_URL = FANTASY_API_URL + '/game/stats?format=json'
+
+# The DraftKings data is the only <pre> block on a rotoguru page
+_PRE_RE = re.compile(r'<pre\b[^>]*>(.*?)</pre\s*>', re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]*>')
+
+_stat_names = None
+
+def rotoguru_scrape(week=1, year=2017, client=None):
     '''
     This function scrapes the DraftKings data from rotoguru.
 
@@ -22,24 +43,73 @@ def rotoguru_scrape(week=1, year=2017):
     
     year: {int} the NFL season year
 
+    client: {ScrapingClient} the client to request the page with, defaults to
+            the shared one
+
     RETURNS
     -------
-    df: {pandas.DataFrame} a DataFrame containing the data
+    df: {pandas.DataFrame} a DataFrame containing the data, or False if the
+        page could not be retrieved
     '''
-    url = 'http://rotoguru1.com/cgi-bin/fyday.pl?'
+    import requests
+
+    try:
+        with metrics.stage('scrape', table='draftkings', year=year, week=week):
+            return _fetch_rotoguru(week, year, client or get_client())
+    except requests.RequestException:
+        return False
+
+def _fetch_rotoguru(week, year, client):
+    return _parse_rotoguru(_fetch_rotoguru_page(week, year, client))
+
+def _fetch_rotoguru_page(week, year, client):
     payload = {'week': week,
                'year': year,
                'game': 'dk',
                'scsv': 1
               }
-    response = requests.get(url, payload)
-    
-    if response.status_code != 200:
-        return False
+    response = client.get(ROTOGURU_URL, payload)
+
+    return response.text
+
+def _extract_pre(html_str):
+    '''
+    This function pulls the text of the first <pre> block out of a page by
+    searching for its tags, without parsing the rest of the page
+
+    PARAMETERS
+    ----------
+    html_str: {str} the html of the page
 
-    html_str = response.text
-    bs_obj = BeautifulSoup(html_str, 'html.parser')
-    scsv = bs_obj.find('pre').getText()
+    RETURNS
+    -------
+    text: {str} the text of the block, with any tags inside it removed and
+          its entities unescaped
+
+    RAISES
+    ------
+    ValueError: when the page has no <pre> block
+    '''
+    match = _PRE_RE.search(html_str)
+    if match is None:
+        raise ValueError('The page has no <pre> block')
+
+    return html.unescape(_TAG_RE.sub('', match.group(1)))
+
+def _parse_rotoguru(html_str):
+    '''
+    This function parses the semi-colon separated DraftKings data out of a
+    rotoguru page
+
+    PARAMETERS
+    ----------
+    html_str: {str} the html of the page
+
+    RETURNS
+    -------
+    df: {pandas.DataFrame} a DataFrame containing the data
+    '''
+    scsv = _extract_pre(html_str)
 
     # Read string to DataFrame
     data = io.StringIO(scsv)
@@ -47,24 +117,16 @@ def rotoguru_scrape(week=1, year=2017):
     # Set columns to lowercase and remove non-alphanumeric characters
     df.columns = df.columns.map(lambda x: ''.join(c for c in x if c.isalnum()).lower())
 
-    # Reformat name column
-    new_names=[]
-    for name in df['name']:
-        if ',' in name:
-            names = name.split(', ')
-            names.reverse()
-            name = ' '.join(names)
-        new_names.append(name)
-
-    df['name'] = new_names
+    # Reformat names from "Last, First" to "First Last"
+    df['name'] = df['name'].str.split(', ').str[::-1].str.join(' ')
 
     # Capitalize positions and teams
-    df['pos'] = df['pos'].map(lambda x: x.upper())
-    df['team'] = df['team'].map(lambda x: x.upper())
+    df['pos'] = df['pos'].str.upper()
+    df['team'] = df['team'].str.upper()
 
     return df
 
-def stat_scrape(week=1, year=2017):
+def stat_scrape(week=1, year=2017, client=None):
     '''
     This function scrapes the passer stats from NFL's fantasy api.
 
@@ -74,43 +136,97 @@ def stat_scrape(week=1, year=2017):
     
     year: {int} the NFL season year
 
+    client: {ScrapingClient} the client to request the stats with, defaults
+            to the shared one
+
     RETURNS
     -------
-    scsv: {str} a string containing the semi-colon separated data
+    df: {pandas.DataFrame} a DataFrame containing the stats, or False if they
+        could not be retrieved
     '''
+    import requests
+
+    try:
+        with metrics.stage('scrape', table='fantasy', year=year, week=week):
+            return _fetch_stats(week, year, client or get_client())
+    except requests.RequestException:
+        return False
+
+def _fetch_stats(week, year, client):
     # Retrive stats for the given week and season in JSON format
-    url = 'http://api.fantasy.nfl.com/v1/players/stats?'
     payload = {'week': week,
                 'season': year,
                 'format': 'json',
                 'statType': 'weekStats'
                 }
-    response = requests.get(url, payload)
+    response = client.get(FANTASY_API_URL + '/players/stats', payload)
 
-    if response.status_code != 200:
-        return False
+    return _parse_stats(response.json()['players'], week, year)
 
-    # Convert to a pandas DataFrame
-    df = pd.DataFrame(response.json()['players'])
+def _decode_stats(stats, n_stats):
+    '''
+    This function writes the stats mapping of every player straight into a
+    NumPy array, indexed by stat id
 
-    df.columns = df.columns.map(lambda x: ''.join(c for c in x \
-                            if c.isalnum()).lower())
+    PARAMETERS
+    ----------
+    stats: {iterable} a dict from stat id to value for each player, or NaN for
+           a player without stats
 
-    # Parse out stats
-    stats_df = df['stats'].apply(pd.Series, dtype=float)
-    stats_df.fillna(0, inplace=True)
-    stats_df.columns = stats_df.columns.map(int)
+    n_stats: {int} the number of stats, ids run from 1 to n_stats
+
+    RETURNS
+    -------
+    values: {array} a (players, n_stats) float32 array where column i holds
+            stat id i+1, and stats a player is missing are 0
+    '''
+    stats = [player if isinstance(player, dict) else {} for player in stats]
+    values = np.zeros((len(stats), n_stats), dtype=np.float32)
 
-    # Add columns for missing stats
-    for i in range(1,94):
-        if i not in stats_df.columns:
-            stats_df[i] = np.zeros(stats_df.shape[0])
+    # Gather every (player, stat) pair in one pass, then assign them at once
+    counts = np.fromiter(map(len, stats), dtype=np.intp, count=len(stats))
+    rows = np.repeat(np.arange(len(stats)), counts)
+    cols = np.fromiter((int(k) for player in stats for k in player),
+                       dtype=np.intp, count=rows.size) - 1
+    vals = np.fromiter((float(v) for player in stats for v in player.values()),
+                       dtype=np.float32, count=rows.size)
+
+    # Ignore any stat ids the api adds past the known ones
+    known = (cols >= 0) & (cols < n_stats)
+    values[rows[known], cols[known]] = vals[known]
+
+    return values
+
+def _parse_stats(players, week, year):
+    '''
+    This function turns the players of NFL's fantasy api into a DataFrame with
+    a column for every stat
+
+    PARAMETERS
+    ----------
+    players: {list} the players of the api response
+
+    week: {int} the week of the NFL season
+    
+    year: {int} the NFL season year
+
+    RETURNS
+    -------
+    df: {pandas.DataFrame} a DataFrame containing the stats
+    '''
+    # Convert to a pandas DataFrame
+    df = pd.DataFrame(players)
 
-    stats_df = stats_df[[i for i in range(1,94)]]
-    stats_df.columns = stat_names
+    df.columns = df.columns.map(lambda x: ''.join(c for c in x \
+                            if c.isalnum()).lower())
 
-    # Kickoff and punt return yards and touchdowns are duplicates
-    stats_df.drop(columns='duplicate')
+    # Parse out stats, dropping the duplicate kickoff and punt return columns
+    stat_names = get_stat_names()
+    keep = [i for i, name in enumerate(stat_names) if name != 'duplicate']
+    values = _decode_stats(df['stats'], len(stat_names))
+    stats_df = pd.DataFrame(values[:, keep],
+                            columns=[stat_names[i] for i in keep],
+                            index=df.index)
 
     df = pd.concat([df.drop(columns='stats'), stats_df], axis=1)
     df['week'] = np.zeros(df.shape[0], dtype=int) + week
@@ -118,60 +234,168 @@ def stat_scrape(week=1, year=2017):
 
     return df
 
+SCRAPERS = {'draftkings': _fetch_rotoguru, 'fantasy': _fetch_stats}
+
+def scrape_weeks(weeks, table_name='fantasy', client=None):
+    '''
+    This function scrapes many weeks at once, sharing the client's connection
+    pool, rate limit and retries between them
+
+    PARAMETERS
+    ----------
+    weeks: {list} (week, year) tuples
+
+    table_name: {str} 'fantasy' for the stats from NFL's fantasy api, or
+                'draftkings' for the DraftKings data from rotoguru
+
+    client: {ScrapingClient} the client to request the data with, defaults to
+            the shared one
+
+    RETURNS
+    -------
+    frames: {dict} a DataFrame for each (week, year) that was retrieved
+
+    errors: {dict} the exception of each (week, year) that failed
+    '''
+    weeks = list(weeks)
+
+    with metrics.stage('scrape', table=table_name, n_weeks=len(weeks)) as m:
+        frames, errors = (client or get_client()).map(SCRAPERS[table_name],
+                                                      weeks)
+        m['n_errors'] = len(errors)
+
+    return frames, errors
+
 def to_database(df, table_name):
     '''
-    This function takes the web-scraped data and inserts it to a Postgres
-    database
+    This function takes the web-scraped data and upserts it to the storage
+    backend, so loading a week again replaces its rows instead of duplicating
+    them
 
     PARAMETERS
     ----------
-    scsv: {str} a string containing the semi-colon separated data
-    table_name: {str} table name
+    df: {pandas.DataFrame} the scraped data
+
+    table_name: {str} table name, 'fantasy' or 'draftkings'
 
     RETURNS
     -------
     None
     '''
-    df.to_sql(table_name, engine, if_exists='append', index=False)
+    with metrics.stage('to_database', table=table_name, n_rows=len(df)):
+        get_backend().write(df, table_name)
+
+    # Only the fantasy table is read through the query cache
+    if table_name == 'fantasy':
+        for year, week in df[['year', 'week']].drop_duplicates().values:
+            get_query_cache().invalidate(year, week)
 
     return
 
-# Retrieve information on stats
-stat_url = 'http://api.fantasy.nfl.com/v1/game/stats?format=json'
-response = requests.get(stat_url)
-stats = response.json()['stats']
+def _clean_stat_names(stats):
+    '''
+    This function turns the stats of NFL's fantasy api into column names
+
+    PARAMETERS
+    ----------
+    stats: {list} dicts with the id and name of each stat
+
+    RETURNS
+    -------
+    stat_names: {list} the column name of each stat, ordered by id
+    '''
+    # Create list where the id is the key and the abbreviation of the stat
+    # is the value
+    stat_names = []
+    for stat in sorted(stats, key=lambda stat: int(stat['id'])):
+        stat_names.append(stat['name'])
+
+    # Postgres does not like columns that begin with integers
+    stat_names[31] = 'two_point_conversions'
+
+    # Kickoff and punt return yards/touchdowns are duplicates
+    stat_names[51] = 'duplicate'
+    stat_names[52] = 'duplicate'
+
+    # Clean stat_names
+    stat_names = [name.replace(' ', '_') for name in stat_names]
+    stat_names = [name.replace('+', 'plus') for name in stat_names]
+    stat_names = [name.replace('-', '_') for name in stat_names]
+    stat_names = list(map((lambda x: ''.join(c for c in x if (c.isalnum() or c == '_')).lower()), stat_names))
 
-# Create list where the id is the key and the abbreviation of the stat
-# is the value
-stat_names = []
-for stat in stats:
-    stat_names.append(stat['name'])
+    return stat_names
 
-# Postgres does not like columns that begin with integers
-stat_names[31] = 'two_point_conversions'
+def refresh_stat_names(path=STAT_NAMES_PATH):
+    '''
+    This function retrieves information on stats from NFL's fantasy api and
+    saves it to the local stat names file
+
+    PARAMETERS
+    ----------
+    path: {str} where to save the stat names
+
+    RETURNS
+    -------
+    stats: {list} dicts with the id and name of each stat
+    '''
+    response = get_client().get(STAT_URL)
+    stats = [{'id': int(stat['id']), 'name': stat['name']}
+             for stat in response.json()['stats']]
 
-# Kickoff and punt return yards/touchdowns are duplicates
-stat_names[51] = 'duplicate'
-stat_names[52] = 'duplicate'
+    with open(path, 'w') as f:
+        json.dump({'version': STAT_NAMES_VERSION, 'source': STAT_URL,
+                   'stats': stats}, f, indent=2)
 
-# Clean stat_names
-stat_names = [name.replace(' ', '_') for name in stat_names]
-stat_names = [name.replace('+', 'plus') for name in stat_names]
-stat_names = [name.replace('-', '_') for name in stat_names]
-stat_names = list(map((lambda x: ''.join(c for c in x if (c.isalnum() or c == '_')).lower()), stat_names))
+    return stats
 
+def get_stat_names():
+    '''
+    This function returns the column names of the stats, reading them from the
+    local stat names file on first use. The file is only fetched again from
+    NFL's fantasy api when it is missing or from an older version.
+
+    RETURNS
+    -------
+    stat_names: {list} the column name of each stat, ordered by id
+    '''
+    global _stat_names
+
+    if _stat_names is None:
+        try:
+            with open(STAT_NAMES_PATH) as f:
+                schema = json.load(f)
+        except (IOError, ValueError):
+            schema = {}
+
+        if schema.get('version') == STAT_NAMES_VERSION:
+            stats = schema['stats']
+        else:
+            stats = refresh_stat_names()
 
+        _stat_names = _clean_stat_names(stats)
+
+    return _stat_names
+
+def _query_totals(q):
+    # Databases loaded before the totals were kept get them built on first use
+    backend = get_backend()
+    backend.ensure_totals('fantasy')
+
+    return backend.query(q)
 
 def query_avg(pos='QB', year=2017):
     '''
     This function queries the database and returns a pandas DataFrame containing
     the id, name, position, and weekly average fantasy points of the players by
-    position
+    position. The averages are read from the running totals that to_database
+    keeps up to date, so no weeks are scanned, and through the query cache.
 
     PARAMETERS
     ----------
     pos: {str} to filter out certain positions, default returns QB
 
+    year: {int} the NFL season year
+
     RETURNS
     -------
     {pandas.DataFrame} a DataFrame containing the relevant data
@@ -181,77 +405,82 @@ def query_avg(pos='QB', year=2017):
     SELECT id,
         name,
         position AS pos,
-        AVG(weekpts) AS avg_points,
-        AVG(passing_attempts) AS avg_passing_attempts,
-        AVG(passing_completions) AS avg_passing_completions,
-        AVG(incomplete_passes) AS avg_incomplete_passes,
-        AVG(passing_yards) AS avg_passing_yards,
-        AVG(passing_touchdowns) AS avg_passing_touchdowns,
-        AVG(interceptions_thrown) AS avg_interceptions_thrown,
-        AVG(every_time_sacked) AS avg_every_time_sacked,
-        AVG(rushing_attempts) AS avg_rushing_attempts,
-        AVG(rushing_yards) AS avg_rushing_yards,
-        AVG(rushing_touchdowns) AS avg_rushing_touchdowns,
-        AVG(receptions) AS avg_receptions,
-        AVG(receiving_yards) AS avg_receiving_yards,
-        AVG(receiving_touchdowns) AS avg_receiving_touchdowns,
-        AVG(kickoff_and_punt_return_yards) AS avg_kickoff_and_punt_return_yards,
-        AVG(kickoff_and_punt_return_touchdowns) AS avg_kickoff_and_punt_return_touchdowns,
-        AVG(fumble_recovered_for_td) AS avg_fumble_recovered_for_td,
-        AVG(fumbles_lost) AS avg_fumbles_lost,
-        AVG(fumble) AS avg_fumble,
-        AVG(two_point_conversions) AS avg_2_point_conversions,
-        AVG(pat_made) AS avg_pat_made,
-        AVG(pat_missed) AS avg_pat_missed,
-        AVG(fg_made_0_19) AS avg_fg_made_0_19,
-        AVG(fg_made_20_29) AS avg_fg_made_20_29,
-        AVG(fg_made_30_39) AS avg_fg_made_30_39,
-        AVG(fg_made_40_49) AS avg_fg_made_40_49,
-        AVG(fg_made_50plus) AS avg_fg_made_50plus,
-        AVG(fg_missed_0_19) AS avg_fg_missed_0_19,
-        AVG(fg_missed_20_29) AS avg_fg_missed_20_29,
-        AVG(fg_missed_30_39) AS avg_fg_missed_30_39,
-        AVG(fg_missed_40_49) AS avg_fg_missed_40_49,
-        AVG(fg_missed_50plus) AS avg_fg_missed_50plus,
-        AVG(sacks) AS avg_sacks,
-        AVG(interceptions) AS avg_interceptions,
-        AVG(fumbles_recovered) AS avg_fumbles_recovered,
-        AVG(fumbles_forced) AS avg_fumbles_forced,
-        AVG(safeties) AS avg_safeties,
-        AVG(touchdowns) AS avg_touchdowns,
-        AVG(blocked_kicks) AS avg_blocked_kicks,
-        AVG(points_allowed) AS avg_points_allowed,
-        AVG(yards_allowed) AS avg_yards_allowed,
-        AVG(tackle) AS avg_tackle,
-        AVG(assisted_tackles) AS avg_assisted_tackles,
-        AVG(sack) AS avg_sack,
-        AVG(defense_interception) AS avg_defense_interception,
-        AVG(forced_fumble) AS avg_forced_fumble,
-        AVG(fumbles_recovery) AS avg_fumbles_recovery,
-        AVG(touchdown_interception_return) AS avg_touchdown_interception_return,
-        AVG(touchdown_fumble_return) AS avg_touchdown_fumble_return,
-        AVG(touchdown_blocked_kick) AS avg_touchdown_blocked_kick,
-        AVG(blocked_kick_punt_fg_pat) AS avg_blocked_kick_punt_fg_pat,
-        AVG(safety) AS avg_safety,
-        AVG(pass_defended) AS avg_pass_defended,
-        AVG(interception_return_yards) AS avg_interception_return_yards,
-        AVG(fumble_return_yards) AS avg_fumble_return_yards,
-        AVG(qb_hit) AS avg_qb_hit,
-        AVG(sack_yards) AS avg_sack_yards,
-        AVG(def_2_point_return) AS avg_def_2_point_return,
-        AVG(team_def_2_point_return) AS avg_team_def_2_point_return
-    FROM fantasy
-    GROUP BY id, name, pos
-    HAVING position = '{}'
+        weekpts / weeks AS avg_points,
+        passing_attempts / weeks AS avg_passing_attempts,
+        passing_completions / weeks AS avg_passing_completions,
+        incomplete_passes / weeks AS avg_incomplete_passes,
+        passing_yards / weeks AS avg_passing_yards,
+        passing_touchdowns / weeks AS avg_passing_touchdowns,
+        interceptions_thrown / weeks AS avg_interceptions_thrown,
+        every_time_sacked / weeks AS avg_every_time_sacked,
+        rushing_attempts / weeks AS avg_rushing_attempts,
+        rushing_yards / weeks AS avg_rushing_yards,
+        rushing_touchdowns / weeks AS avg_rushing_touchdowns,
+        receptions / weeks AS avg_receptions,
+        receiving_yards / weeks AS avg_receiving_yards,
+        receiving_touchdowns / weeks AS avg_receiving_touchdowns,
+        kickoff_and_punt_return_yards / weeks AS avg_kickoff_and_punt_return_yards,
+        kickoff_and_punt_return_touchdowns / weeks AS avg_kickoff_and_punt_return_touchdowns,
+        fumble_recovered_for_td / weeks AS avg_fumble_recovered_for_td,
+        fumbles_lost / weeks AS avg_fumbles_lost,
+        fumble / weeks AS avg_fumble,
+        two_point_conversions / weeks AS avg_2_point_conversions,
+        pat_made / weeks AS avg_pat_made,
+        pat_missed / weeks AS avg_pat_missed,
+        fg_made_0_19 / weeks AS avg_fg_made_0_19,
+        fg_made_20_29 / weeks AS avg_fg_made_20_29,
+        fg_made_30_39 / weeks AS avg_fg_made_30_39,
+        fg_made_40_49 / weeks AS avg_fg_made_40_49,
+        fg_made_50plus / weeks AS avg_fg_made_50plus,
+        fg_missed_0_19 / weeks AS avg_fg_missed_0_19,
+        fg_missed_20_29 / weeks AS avg_fg_missed_20_29,
+        fg_missed_30_39 / weeks AS avg_fg_missed_30_39,
+        fg_missed_40_49 / weeks AS avg_fg_missed_40_49,
+        fg_missed_50plus / weeks AS avg_fg_missed_50plus,
+        sacks / weeks AS avg_sacks,
+        interceptions / weeks AS avg_interceptions,
+        fumbles_recovered / weeks AS avg_fumbles_recovered,
+        fumbles_forced / weeks AS avg_fumbles_forced,
+        safeties / weeks AS avg_safeties,
+        touchdowns / weeks AS avg_touchdowns,
+        blocked_kicks / weeks AS avg_blocked_kicks,
+        points_allowed / weeks AS avg_points_allowed,
+        yards_allowed / weeks AS avg_yards_allowed,
+        tackle / weeks AS avg_tackle,
+        assisted_tackles / weeks AS avg_assisted_tackles,
+        sack / weeks AS avg_sack,
+        defense_interception / weeks AS avg_defense_interception,
+        forced_fumble / weeks AS avg_forced_fumble,
+        fumbles_recovery / weeks AS avg_fumbles_recovery,
+        touchdown_interception_return / weeks AS avg_touchdown_interception_return,
+        touchdown_fumble_return / weeks AS avg_touchdown_fumble_return,
+        touchdown_blocked_kick / weeks AS avg_touchdown_blocked_kick,
+        blocked_kick_punt_fg_pat / weeks AS avg_blocked_kick_punt_fg_pat,
+        safety / weeks AS avg_safety,
+        pass_defended / weeks AS avg_pass_defended,
+        interception_return_yards / weeks AS avg_interception_return_yards,
+        fumble_return_yards / weeks AS avg_fumble_return_yards,
+        qb_hit / weeks AS avg_qb_hit,
+        sack_yards / weeks AS avg_sack_yards,
+        def_2_point_return / weeks AS avg_def_2_point_return,
+        team_def_2_point_return / weeks AS avg_team_def_2_point_return
+    FROM fantasy_totals
+    WHERE year = {}
+    AND position = '{}'
     ORDER BY avg_points DESC;
-    '''.format(pos)
+    '''.format(year, pos)
 
-    return pd.read_sql(q, engine)
+    with metrics.stage('query_avg', year=year, position=pos) as m:
+        df = get_query_cache().read(year, 'avg', q, _query_totals)
+        m['n_rows'] = len(df)
+
+    return df
 
 def query_week(week=1, year=2017, pos='QB'):
     '''
     This function queries the database and returns a pandas DataFrame containing
-    the id, name, position, and stats for a given week
+    the id, name, position, and stats for a given week. Results are read
+    through the query cache, which to_database clears when it loads the week.
 
     PARAMETERS
     ----------
@@ -332,56 +561,65 @@ def query_week(week=1, year=2017, pos='QB'):
     ORDER BY weekpts DESC;
     '''.format(week, year, pos)
 
-    return pd.read_sql(q, engine)
+    with metrics.stage('query_week', year=year, week=week, position=pos) as m:
+        df = get_query_cache().read(year, week, q, get_backend().query)
+        m['n_rows'] = len(df)
+
+    return df
 
 if __name__ == '__main__':
-    # Instantiate psycopg2 connection to default db
-    conn = psycopg2.connect(host=os.environ['AWS_RDS'],
-                            port=5432, user=os.environ['MASTER_RDS_USERNAME'],
-                            password=os.environ['MASTER_RDS_PASSWORD'])
+    # The Parquet backend needs no database to be set up
+    if isinstance(get_backend(), PostgresBackend):
+        import psycopg2
 
-    conn.autocommit = True # set autocommit on
+        # Instantiate psycopg2 connection to default db
+        conn = psycopg2.connect(host=os.environ['AWS_RDS'], port=5432,
+                                user=os.environ['MASTER_RDS_USERNAME'],
+                                password=os.environ['MASTER_RDS_PASSWORD'])
 
-    c = conn.cursor() # instantiate cursor
+        conn.autocommit = True # set autocommit on
 
-    c.execute("CREATE DATABASE nfl;") # create nfl database
+        c = conn.cursor() # instantiate cursor
 
-    # Write query to create user and make owner of nfl db
-    q = '''
-    CREATE USER {} ENCRYPTED PASSWORD '{}';
+        c.execute("CREATE DATABASE nfl;") # create nfl database
 
-    ALTER DATABASE nfl OWNER TO {};
-    '''.format(os.environ['CLUTCH_USR'],
-               os.environ['CLUTCH_PWD'],
-               os.environ['CLUTCH_USR'])
+        # Write query to create user and make owner of nfl db
+        q = '''
+        CREATE USER {} ENCRYPTED PASSWORD '{}';
 
-    c.execute(q) # execute query
+        ALTER DATABASE nfl OWNER TO {};
+        '''.format(os.environ['CLUTCH_USR'],
+                   os.environ['CLUTCH_PWD'],
+                   os.environ['CLUTCH_USR'])
 
-    conn.close() # close connection
+        c.execute(q) # execute query
 
-    # Loop through weeks 1 through 17 and scrape relevant data
-    for i in range(1,18):
-        dk_df = rotoguru_scrape(week=i)
+        conn.close() # close connection
 
-        if type(dk_df) != pd.DataFrame:
-            print('Failed to retrieve DraftKings data for Week {}'.format(i))
+    # Scrape relevant data for weeks 1 through 17 all at once
+    weeks = [(week, 2017) for week in range(1,18)]
+    dk_frames, dk_errors = scrape_weeks(weeks, table_name='draftkings')
+    stat_frames, stat_errors = scrape_weeks(weeks + [(1, 2018)],
+                                            table_name='fantasy')
+
+    for i, year in weeks:
+        if (i, year) in dk_errors:
+            print('Failed to retrieve DraftKings data for Week {}: {}'.\
+                      format(i, dk_errors[(i, year)]))
         else:
             print('Successfully retrieved DraftKings data for Week {}'.format(i))
-            to_database(dk_df, table_name='draftkings')
-
-        stat_df = stat_scrape(week=i)
+            to_database(dk_frames[(i, year)], table_name='draftkings')
 
-        if type(stat_df) != pd.DataFrame:
-            print('Failed to retrieve fantasy stats for Week {}'.format(i))
+        if (i, year) in stat_errors:
+            print('Failed to retrieve fantasy stats for Week {}: {}'.\
+                      format(i, stat_errors[(i, year)]))
         else:
             print('Successfully retrieved fantasy stats for Week {}'.format(i))
-            to_database(stat_df, table_name='fantasy')
+            to_database(stat_frames[(i, year)], table_name='fantasy')
 
     # Get data for week 1 of 2018
-    stat_df = stat_scrape(week=1, year=2018)
-
-    if type(stat_df) != pd.DataFrame:
+    if (1, 2018) in stat_errors:
         print("Failed to retrieve fantasy stats for Week 1 2018.")
     else:
-        to_database(stat_df, table_name='fantasy')
-        print("Successfully retrieved fantasy stats for Week 1 2018.")        
+        to_database(stat_frames[(1, 2018)], table_name='fantasy')
+        print("Successfully retrieved fantasy stats for Week 1 2018.")
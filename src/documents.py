@@ -0,0 +1,114 @@
+import zlib
+import numpy as np
+
+# Numeric arrays with at least this many elements are stored compressed
+COMPRESS_SIZE = 256
+# Documents bigger than this are stored in GridFS, under the 16 MB BSON limit
+GRIDFS_BYTES = 15 * 2**20
+
+def encode_value(value, compress=True):
+    '''
+    This function turns the values of a plotly JSON dict, or any dict of
+    arrays, into ones BSON can store, compressing large numeric arrays when
+    compress is True. Without compression a plotly JSON dict stays one.
+    '''
+    from bson.binary import Binary
+
+    if isinstance(value, dict):
+        return {key: encode_value(item, compress)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item, compress) for item in value]
+    if isinstance(value, np.ndarray):
+        if compress and value.dtype.kind in 'biuf' and \
+                value.size >= COMPRESS_SIZE:
+            return {'__ndarray__': {
+                'dtype': value.dtype.str,
+                'shape': list(value.shape),
+                'data': Binary(zlib.compress(
+                            np.ascontiguousarray(value).tobytes()))}}
+        value = value.tolist()
+        if isinstance(value, list):
+            return [encode_value(item, compress) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    # Missing values, e.g. the breaks between edges, are stored as nulls,
+    # which plotly reads as breaks too
+    if isinstance(value, float) and value != value:
+        return None
+
+    return value
+
+def decode_value(value):
+    '''
+    This function turns the values encode_value stored back, with the
+    compressed arrays as NumPy arrays
+    '''
+    if isinstance(value, dict):
+        if '__ndarray__' in value:
+            array = value['__ndarray__']
+            return np.frombuffer(zlib.decompress(array['data']),
+                                 dtype=np.dtype(array['dtype'])).\
+                       reshape(array['shape'])
+        return {key: decode_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+
+    return value
+
+def to_gridfs(doc, collection):
+    '''
+    This function stores a document too big for BSON in the GridFS bucket of
+    a collection
+
+    RETURNS
+    -------
+    doc: {dict} the document itself when it fits, or a stub with its name and
+         the id of its GridFS file
+    '''
+    import bson
+    import gridfs
+
+    data = bson.BSON.encode(doc)
+    if len(data) <= GRIDFS_BYTES:
+        return doc
+
+    fs = gridfs.GridFS(collection.database, collection.name)
+    return {'name': doc['name'],
+            'gridfs_id': fs.put(data, filename=doc['name'])}
+
+def from_gridfs(doc, collection):
+    '''
+    This function reads the document a GridFS stub points to, returning any
+    other document as is
+    '''
+    if 'gridfs_id' not in doc:
+        return doc
+
+    import bson
+    import gridfs
+
+    fs = gridfs.GridFS(collection.database, collection.name)
+    return bson.BSON(fs.get(doc['gridfs_id']).read()).decode()
+
+def gridfs_files(collection, names):
+    '''
+    This function lists the GridFS files of the documents with these names
+    '''
+    return [doc['gridfs_id'] for doc in
+            collection.find({'name': {'$in': names},
+                             'gridfs_id': {'$exists': True}},
+                            {'gridfs_id': 1})]
+
+def delete_gridfs(collection, file_ids):
+    '''
+    This function deletes GridFS files of a collection
+    '''
+    if len(file_ids) == 0:
+        return
+
+    import gridfs
+
+    fs = gridfs.GridFS(collection.database, collection.name)
+    for file_id in file_ids:
+        fs.delete(file_id)
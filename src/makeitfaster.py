@@ -3,25 +3,85 @@ import sys
 module_path = os.path.abspath(os.path.join('..'))
 if module_path not in sys.path:
     sys.path.append(module_path)
-import pandas as pd
 import numpy as np
-import dionysus as d
-from itertools import product, combinations
 from scipy.spatial.distance import cdist
-import plotly.plotly as py
-import plotly.graph_objs as go
-import plotly.figure_factory as FF
-import igraph as ig
-import pymongo
 import multiprocessing
-from threading import Thread
+from time import time
+from src.tda import ClutchMapper, _witness_skeleton, _witness_births
+from src.simplicial import Filtration
+
+# Worker processes keep a read-only view of the shared distance matrix here so
+# it is only copied into shared memory once per fit
+_shared = {}
+
+def _init_worker(buffer, shape):
+    '''
+    This function runs once in every worker process and wraps the shared 
+    memory buffer holding the observer-landmark distances in a NumPy array 
+    without copying it
+
+    PARAMETERS
+    ----------
+    buffer: {multiprocessing.RawArray} the shared distance matrix
+
+    shape: {tuple} the shape of the distance matrix
+    '''
+    _shared['visibility'] = np.frombuffer(buffer).reshape(shape)
+
+def _witness_distances(name):
+    visibility = _shared['visibility']
+
+    # For the observation complex the landmarks are the witnesses
+    if name == 'observer':
+        return visibility.T
+
+    return visibility
+
+def _build_skeleton(task):
+    '''
+    This function builds every simplex up to dimension k of the observation or
+    landmark complex
+
+    PARAMETERS
+    ----------
+    task: {tuple} the name of the complex, the highest dimension of the
+          simplices and the largest visibility threshold
+
+    RETURNS
+    -------
+    result: {tuple} the name of the complex and, for each dimension, the
+            simplices as an int32 array
+    '''
+    name, k, end = task
+    skeleton = _witness_skeleton(_witness_distances(name) <= end, k)
+
+    return name, [simplices.astype(np.int32) for simplices in skeleton]
+
+def _build_births(task):
+    '''
+    This function computes the visibility threshold a chunk of simplices of
+    the observation or landmark complex is born at
+
+    PARAMETERS
+    ----------
+    task: {tuple} the name of the complex and a (m, r) array of simplices
+
+    RETURNS
+    -------
+    births: {array} the birth of each simplex
+    '''
+    name, simplices = task
+
+    return _witness_births(_witness_distances(name), simplices)
 
 class FasterClutchMapper:
 
-    def __init__(self, metric='euclidean'):
+    def __init__(self, metric='euclidean', n_jobs=None):
         '''
         The FasterClutchMapper object is am implementation of landmark-based
-        navigation designed to work with NFL Fantasy data. 
+        navigation designed to work with NFL Fantasy data. It builds its 
+        filtrations in parallel with n_jobs worker processes, which defaults to
+        the number of CPUs.
 
         Note: I named the observation complexes and related variables with the 
         'observer' prefix instead of 'observation' because 'observer' and 
@@ -29,8 +89,9 @@ class FasterClutchMapper:
         nicely that way.
         '''
         self.metric = 'euclidean'
+        self.n_jobs = n_jobs
     
-    def fit(self, data, labels):
+    def fit(self, data, labels, k=2):
         '''
         PARAMETERS
         ----------
@@ -38,6 +99,8 @@ class FasterClutchMapper:
 
         labels: {array} labels from clustering the data in a reduced 
                 dimensionality that become the observers
+
+        k: {int} specify up to which dimension k-complex to calculate
         '''
         self.landmarks_ = data
         self.labels = labels
@@ -48,24 +111,7 @@ class FasterClutchMapper:
         self.L_= range(len(self.landmarks_))
         self.visibility_ = cdist(self.observers_, self.landmarks_, metric=self.metric)
 
-        # Now we build the filtration!!! 
-        # Instantiate the filtrations as lists
-        self.observer_filtration_ = []
-        self.landmark_filtration_ = []
-
-        # Set the end of the filtration to be the maximum visibility
-        end = self.visibility_.max()
-        
-        # Create a multiprocessing pool
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-        p_range = np.linspace(0,end)
-
-        # Build iterative complexes and add simplices to filtration with the 
-        # visibility threshold they were born
-        pool.map(self._build_filtrations, p_range)
-
-        for p in p_range:
-            self._build_filtrations(p)
+        self._build_filtrations(k=k)
 
     def _build_cover(self):
         '''
@@ -89,273 +135,105 @@ class FasterClutchMapper:
 
         return
 
-    def _build_observer_complex(self, p):
+    def _build_filtrations(self, end=None, k=2):
         '''
-        This method constructs the simplices for a the observation complex with 
-        the given visibility threshold and adds the simplices to the filtration
+        This method builds the observation and landmark filtrations in worker
+        processes. The distance matrix is shared with the workers through 
+        shared memory. Each complex's skeleton is built once by one worker,
+        then the births of its simplices are computed in chunks across the
+        whole pool and merged into filtrations sorted by the visibility 
+        threshold they were born at.
 
         PARAMETERS
         ----------
-        p: {float} the visibility threshold to form simplices
+        end: {float} the largest visibility threshold, defaults to the maximum
+             visibility
 
-        # TODO: Implement this
-        k_max: {int} specifify up to which dimension k-complex to calculate
+        k: {int} specify up to which dimension k-complex to calculate
         '''
-        # Subtract the distances computed in the fit method from p to see which
-        # observations and landmarks are visible to each other
-        visibility = np.sign(p - self.visibility_)
-        # If visibility[o,l] is -1, l is within p of o
-        # If visibility[o,l] is 1, l is within p of o
-
-        # Observation Complex
-        # ----------------
-        # Observation are the centroids of the cover we build 
-        # k-simplices are collections of (k+1) distinct observations that have
-        # some landmark in common
-
-        # 0-simplices (vertices) are added when an observation is visible
-        # to a landmark
-        for i in self.O_:
-            for l in self.L_:
-                if visibility[i,l]== 1:
-                    self.observer_filtration_.append(([i],p))
-                    break
-
-        # 1-simplices (edges) are added when an two observations are visible to
-        # a landmark
-        for i,j in combinations(self.O_, 2):
-            for l in self.L_:
-                if visibility[i,l]+visibility[j,l] == 2:
-                    # print(i,j)
-                    self.observer_filtration_.append(([i,j],p))
-                    break
-
-        # 2-simplices (faces) are added when three observations are visible to 
-        # a landmark
-        for i,j,k in combinations(self.O_,3):
-            for l in self.L_:
-                if visibility[i,l]+visibility[j,l]+visibility[k,l] == 3:
-                    # print(i,j,k)
-                    self.observer_filtration_.append(([i,j,k],p))
-                    break
-
-        # # 3-simplices (tetrahedra) are added when four observations are 
-        # # visible to a landmark
-        # for i,j,k,h in combinations(self.O_,4):
-        #     for l in self.L_:
-        #         if visibility[i,l]+visibility[j,l]+visibility[k,l]+visibility[h,l] == 4:
-        #             self.observation_filtration_.append(([i,j,k,h],p))
-        #             break
-
-        return self
-        
-    def _build_landmark_complex(self, p):
-        '''
-        This method constructs the simplices for the landmark complex with the  
-        given visibility threshold and adds the simplices to the filtration
-
-        PARAMETERS
-        ----------
-        p: {float} the visibility threshold to form simplices
-        '''
-        # Subtract the distances computed in the fit method from p to see which
-        # observations and landmarks are visible to each other
-        visibility = np.sign(p - self.visibility_)
-        # If visibility[o,l] is -1, l is within p of o
-        # If visibility[o,l] is 1, l is within p of o
-
-        # Landmark Complex
-        # ----------------
-        # Landmarks are the data points of each player 
-        # k-simplexes are collections of (k+1) distinct landmarks that have some
-        # observation in common
-
-        # 0-simplices (vertices) are added when a landmark is visible to an 
-        # observation
-        for i in self.L_:
-            for o in self.O_:
-                if visibility[o,i] == 1:
-                    self.landmark_filtration_.append(([i],p))
-
-        # 1-simplices (edges) are added when two landmarks are visible to an
-        # observation
-        for i,j in combinations(self.L_, 2):
-            for o in self.O_:
-                if visibility[o,i]+visibility[o,j] == 2:
-                    self.landmark_filtration_.append(([i,j],p))
-
-        # 2-simplices (faces) are added when three landmarks are visible to an
-        # observation
-        for i,j,k in combinations(self.L_,3):
-            for o in self.O_:
-                if visibility[o,i]+visibility[o,j]+visibility[o,k] == 3:
-                    self.landmark_filtration_.append(([i,j,k], p))
-
-
-        # # 3-simplices (tetrahedra) are added when four landmarks are visible 
-        # # to an observation
-        # for i,j,k,h in combinations(self.L_4):
-        #     for o in self.O_:
-        #         if visibility[o,i]+visibility[o,j]+visibility[o,k]+visibility[o,h] == 4:
-        #             self.landmark_filtration_.append(([i,j,k,h], p))
-        #             break
-
-        return 
-
-    def _build_filtrations(self, p):
-        '''
-        This method calls the build_observation_complex and 
-        build_landmark_complex methods to create the filtration
-
-        PARAMETERS
-        ----------
-        p: {float} the visibility threshold to form simplices
+        # Set the end of the filtration to be the maximum visibility
+        if end is None:
+            end = self.visibility_.max()
 
-        # TODO: Implement this
-        k_max: {int} specify up to which dimension k-complex to calculate
-        '''
-        threads = []
-        
-        threads.append(Thread(target=self._build_observer_complex, args=([p])))
-        threads.append(Thread(target=self._build_landmark_complex, args=([p])))
+        # Copy the distances into shared memory once for all of the workers
+        shape = self.visibility_.shape
+        buffer = multiprocessing.RawArray('d', self.visibility_.size)
+        np.frombuffer(buffer).reshape(shape)[:] = self.visibility_
 
-        for t in threads:
-            t.start()
-        
-        for t in threads:
-            t.join()
+        names = ['observer', 'landmark']
+        n_jobs = self.n_jobs or multiprocessing.cpu_count()
 
-        return
+        # Create a multiprocessing pool
+        with multiprocessing.Pool(processes=n_jobs,
+                                  initializer=_init_worker,
+                                  initargs=(buffer, shape)) as pool:
+            # The skeleton of each complex is built once, all dimensions
+            # together, since each dimension is extended from the one below
+            skeletons = dict(pool.map(_build_skeleton,
+                                      [(name, k, end) for name in names]))
+
+            # The births are most of the work, and most of them are in the
+            # top dimension, so every dimension is split into chunks of
+            # simplices that are spread over the whole pool
+            tasks, slots = [], []
+            for name in names:
+                for dim, simplices in enumerate(skeletons[name]):
+                    step = max(1, -(-simplices.shape[0] // (4 * n_jobs)))
+                    for start in range(0, simplices.shape[0], step):
+                        tasks.append((name, simplices[start:start+step]))
+                        slots.append((name, dim))
+            chunks = pool.map(_build_births, tasks)
+
+        # Merge the chunks of each complex, in order, into a filtration sorted
+        # by birth
+        filtrations = {}
+        for name in names:
+            births = [[] for simplices in skeletons[name]]
+            for (chunk_name, dim), chunk in zip(slots, chunks):
+                if chunk_name == name:
+                    births[dim].append(chunk)
+            births = [np.concatenate(dim_births) if len(dim_births) > 0
+                      else np.empty(0) for dim_births in births]
+            filtrations[name] = Filtration(skeletons[name], births)
+
+        self.observer_filtration_ = filtrations['observer']
+        self.landmark_filtration_ = filtrations['landmark']
 
+        return self
 
-def visualize_complex(simplicial_complex, title=None, names=None):
+def measure_speedup(data, labels):
     '''
-    This function constructs a visualization of the given simplical complex
+    This function fits a ClutchMapper and a FasterClutchMapper to the same data
+    and measures how long each takes to build its filtrations
 
     PARAMETERS
     ----------
-    simplicial_complex: {list} a list containing simplices of the complex
-
-    title: {str} title of the plot
+    data: {array} point cloud data that become the landmarks
 
-    filename: {str} filename of the output plot
+    labels: {array} labels from clustering the data in a reduced 
+            dimensionality that become the observers
 
     RETURNS
     -------
-    fig: {plotly.graph_objs.Figure}
+    timings: {dict} the seconds each mapper took and the speedup
     '''
-    vertices = [simplex for simplex_list in simplicial_complex for simplex in simplex_list if len(simplex_list) == 1]
-    simplex_dict = {v:i for i,v in enumerate(vertices)}
-    edges = [simplex for simplex in simplicial_complex if len(simplex) == 2]
-    edge_list = [[simplex_dict[edge[0]], simplex_dict[edge[1]]] for edge in edges]
-    faces = [simplex for simplex in simplicial_complex if len(simplex) == 3]
-    face_list = [[simplex_dict[face[0]], simplex_dict[face[1]], simplex_dict[face[2]]] for face in faces]
-
-    g = ig.Graph()
-    g.add_vertices(vertices)
-    g.add_edges(edge_list)
-    layt = g.layout('kk_3d')
-
-    x_vertex=[layt[k][0] for k in range(len(vertices))]
-    y_vertex=[layt[k][1] for k in range(len(vertices))]
-    z_vertex=[layt[k][2] for k in range(len(vertices))]
-
-    x_edge = []
-    y_edge = []
-    z_edge = []
-
-    for edge in edge_list:
-        x_edge += [layt[edge[0]][0], layt[edge[1]][0], None]
-        y_edge += [layt[edge[0]][1], layt[edge[1]][1], None]
-        z_edge += [layt[edge[0]][2], layt[edge[1]][2], None]
-
-    if names == None:
-        names = vertices
-    else:
-        names = list(np.array(names)[vertices])
-        
-    data = [
-        go.Scatter3d(
-            x = x_vertex,
-            y = y_vertex,
-            z = z_vertex,
-            mode = 'markers',
-            name = 'Vertices',
-            marker=dict(symbol='circle',
-                                size=6,
-                                color=vertices,
-                                colorscale='Viridis',
-                                line=dict(color='rgb(50,50,50)', width=0.5)
-                                ),
-                text=names,
-                hoverinfo='text'
-        ),
-        go.Scatter3d(
-            x = x_edge,
-            y = y_edge,
-            z = z_edge,
-            mode = 'lines',
-            name = 'Edges'
-        ),
-    ]
-
-    if len(faces) > 0:
-        i, j, k = np.array(face_list).T
-        data.append(
-            go.Mesh3d(
-                x = x_vertex,
-                y = y_vertex,
-                z = z_vertex,
-                i = [np.asscalar(n) for n in i],
-                j = [np.asscalar(n) for n in j],
-                k = [np.asscalar(n) for n in k],
-                opacity = 0.25,
-                name = 'Faces'
-            )
-        )
-        
-
-    axis=dict(showbackground=False,
-            showline=False,
-            zeroline=False,
-            showgrid=False,
-            showticklabels=False,
-            title=''
-            )
-
-    layout = go.Layout(
-            title=title,
-            width=800,
-            height=600,
-            showlegend=False,
-            scene=dict(
-                xaxis=dict(axis),
-                yaxis=dict(axis),
-                zaxis=dict(axis),
-            ),
-        margin=dict(
-            t=100
-        )
-    )
-    fig = go.Figure(data=data, layout=layout)
-
-    return fig
-
-client = pymongo.MongoClient()
-db_name = 'nfl'
-db = client[db_name]
-collection_name = 'complexes'
-COMPLEXES = db[collection_name]
-COMPLEXES.create_index([('name', pymongo.ASCENDING)], unique=True)
-
-def visualization_to_db(figure, name):
-    fig_json = figure.to_plotly_json()
-    fig_json['name'] = name
-    COMPLEXES.insert_one(fig_json)
+    start = time()
+    cmapper = ClutchMapper()
+    cmapper.fit(data, labels)
+    cmapper.build_filtrations()
+    clutch_time = time() - start
+
+    start = time()
+    faster_cmapper = FasterClutchMapper()
+    faster_cmapper.fit(data, labels)
+    faster_time = time() - start
+
+    return {'clutch_mapper': clutch_time,
+            'faster_clutch_mapper': faster_time,
+            'speedup': clutch_time / faster_time}
 
 if __name__ == '__main__':
-    from src.data_pipeline import query_avg, query_week
-    from time import time
+    from src.data_pipeline import query_week
     from sklearn.cluster import AgglomerativeClustering
     from sklearn.preprocessing import StandardScaler
 
@@ -373,12 +251,13 @@ if __name__ == '__main__':
     scaler = StandardScaler()
     scaled_stats = scaler.fit_transform(stats)
 
-    faster_cmapper = FasterClutchMapper()
-    start = time()
-    faster_cmapper.fit(scaled_stats, labels)
-    end = time()
+    timings = measure_speedup(scaled_stats, labels)
 
-    print("Fitting FasterClutchMapper took {} seconds".format(end-start))
+    print("Fitting ClutchMapper took {} seconds".format(
+              timings['clutch_mapper']))
+    print("Fitting FasterClutchMapper took {} seconds".format(
+              timings['faster_clutch_mapper']))
+    print("FasterClutchMapper was {:.1f}x faster".format(timings['speedup']))
     
     # for n, pos in zip(n_sets, positions):
     #     for week in range(1,18):
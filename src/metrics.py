@@ -0,0 +1,247 @@
+import os
+import json
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter, time
+
+# CLUTCH_METRICS is the JSON lines file the stages are recorded to, and
+# CLUTCH_PROFILE the directory cProfile dumps go to. Both are off when unset.
+# CLUTCH_METRICS_MEMORY also records the peak memory of each stage, which
+# traces every allocation and slows the stages down.
+METRICS_PATH = os.environ.get('CLUTCH_METRICS')
+PROFILE_DIR = os.environ.get('CLUTCH_PROFILE')
+MEMORY = bool(os.environ.get('CLUTCH_METRICS_MEMORY'))
+
+_tags = {}
+# Each thread nests its own stages, e.g. the fetches of ScrapingClient.map
+_local = threading.local()
+
+# The number of stages tracing memory, over every thread, and whether they
+# started tracemalloc
+_tracing = 0
+_started = False
+_tracing_lock = threading.Lock()
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    return _local.stack
+
+def configure(path=None, profile_dir=None, memory=False):
+    '''
+    This function turns the metrics and the profiling on or off. Worker
+    processes started afterwards inherit the setting through the environment.
+
+    PARAMETERS
+    ----------
+    path: {str} the JSON lines file to record the stages to, or None to stop
+          recording
+
+    profile_dir: {str} the directory to dump cProfile stats to, or None to
+                 stop profiling
+
+    memory: {bool} whether to also record the peak memory of each stage,
+            which makes the timings include the overhead of tracing every
+            allocation
+    '''
+    global METRICS_PATH, PROFILE_DIR, MEMORY
+
+    METRICS_PATH = path
+    PROFILE_DIR = profile_dir
+    MEMORY = memory
+
+    for name, value in [('CLUTCH_METRICS', path),
+                        ('CLUTCH_PROFILE', profile_dir),
+                        ('CLUTCH_METRICS_MEMORY', '1' if memory else None)]:
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+def enabled():
+    return METRICS_PATH is not None
+
+class _NullStage:
+    '''
+    The stage handed out while the metrics are off, which ignores everything
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+
+    def __init__(self, name, tags):
+        '''
+        The _Stage object times one stage and, when MEMORY is on, measures
+        its peak memory. Extra measurements, e.g. the number of simplices, can
+        be set on it like on a dict. Stages nest per thread, but tracemalloc
+        traces the whole process, so the peak of a stage that overlaps stages
+        on other threads includes their allocations too. With MEMORY on the
+        timings include the overhead of tracing, and tracing stops again once
+        the outermost stage exits.
+        '''
+        self.record = dict(_tags, stage=name, **tags)
+        self.memory = MEMORY
+
+    def __setitem__(self, key, value):
+        self.record[key] = value
+
+    def __enter__(self):
+        if not self.memory:
+            self.start = perf_counter()
+            return self
+
+        global _tracing, _started
+
+        # Only trace allocations while some stage is open, and leave alone
+        # tracing someone else started, e.g. the benchmarks
+        with _tracing_lock:
+            if _tracing == 0:
+                _started = not tracemalloc.is_tracing()
+                if _started:
+                    tracemalloc.start()
+            _tracing += 1
+
+        # Hand the peak so far to the enclosing stage before measuring this
+        # one from scratch
+        stack = _stack()
+        if len(stack) > 0:
+            stack[-1].peak = max(stack[-1].peak,
+                                 tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self.base, self.peak = tracemalloc.get_traced_memory()
+        stack.append(self)
+
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = perf_counter() - self.start
+        self.record.update(seconds=seconds, pid=os.getpid(), time=time())
+
+        if self.memory:
+            global _tracing
+
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            stack = _stack()
+            stack.pop()
+            if len(stack) > 0:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+
+            # Only count what the stage allocated on top of what was already
+            # allocated when it started
+            self.record['peak_bytes'] = self.peak - self.base
+
+            with _tracing_lock:
+                _tracing -= 1
+                if _tracing == 0 and _started:
+                    tracemalloc.stop()
+
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        _write(self.record)
+
+        return False
+
+def _write(record):
+    # Append each record in a single write, so records from several worker
+    # processes do not interleave
+    line = json.dumps(record, sort_keys=True, default=str) + '\n'
+    fd = os.open(METRICS_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+def stage(name, **tags):
+    '''
+    This function times a stage of the pipeline when the metrics are on, e.g.
+
+        with metrics.stage('build_complex', threshold=p) as m:
+            ...
+            m['n_simplices'] = len(landmark_complex)
+
+    PARAMETERS
+    ----------
+    name: {str} the name of the stage
+
+    tags: the tags to record with the stage, on top of the current ones
+
+    RETURNS
+    -------
+    stage: a context manager that records the stage as it exits
+    '''
+    if METRICS_PATH is None:
+        return _NULL_STAGE
+
+    return _Stage(name, tags)
+
+def count(name, value=1, **tags):
+    '''
+    This function records a counter when the metrics are on
+
+    PARAMETERS
+    ----------
+    name: {str} the name of the counter
+
+    value: {int} the count
+
+    tags: the tags to record with the counter, on top of the current ones
+    '''
+    if METRICS_PATH is None:
+        return
+
+    _write(dict(_tags, counter=name, value=value, pid=os.getpid(),
+                time=time(), **tags))
+
+@contextmanager
+def tags(**new_tags):
+    '''
+    This function adds tags, e.g. the year, week and position of a job, to
+    every stage and counter recorded inside it
+
+    PARAMETERS
+    ----------
+    new_tags: the tags
+    '''
+    previous = dict(_tags)
+    _tags.update(new_tags)
+    try:
+        yield
+    finally:
+        _tags.clear()
+        _tags.update(previous)
+
+@contextmanager
+def profile(name):
+    '''
+    This function profiles the code inside it with cProfile and dumps the
+    stats to <CLUTCH_PROFILE>/<name>.prof when profiling is on
+
+    PARAMETERS
+    ----------
+    name: {str} the name of the dump
+    '''
+    if PROFILE_DIR is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
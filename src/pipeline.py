@@ -0,0 +1,479 @@
+import os
+import sys
+module_path = os.path.abspath(os.path.join('..'))
+if module_path not in sys.path:
+    sys.path.append(module_path)
+import argparse
+import json
+import multiprocessing
+import tempfile
+import traceback
+from collections import namedtuple
+from itertools import product
+from time import time
+import numpy as np
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.preprocessing import StandardScaler
+from src import metrics
+
+POSITIONS = ['QB', 'RB', 'WR', 'TE', 'K', 'DEF', 'LB', 'DB', 'DL']
+N_SETS = dict(zip(POSITIONS, [5, 12, 12, 11, 8, 7, 11, 7, 10]))
+THRESHOLDS = np.arange(0, 10.1, 0.5)
+MAX_PLAYERS = 100
+
+# A job is one position in one week of a season, where a week of 'avg' stands
+# for the season averages
+Job = namedtuple('Job', ['year', 'week', 'position'])
+
+def expand_grid(years, weeks, positions=POSITIONS):
+    '''
+    This function expands a grid of years, weeks and positions into jobs
+
+    PARAMETERS
+    ----------
+    years: {list} the NFL season years
+
+    weeks: {list} the weeks of the NFL season, or 'avg' for the averages
+
+    positions: {list} the positions
+
+    RETURNS
+    -------
+    jobs: {list} a Job for every combination
+    '''
+    return [Job(year, week, position)
+            for year, week, position in product(years, weeks, positions)]
+
+def job_key(job):
+    '''
+    This function names a job in the checkpoint manifest, e.g. 2017_1_QB
+    '''
+    return '{}_{}_{}'.format(*job)
+
+def invalidate_manifest(year, week, manifest='pipeline_manifest.json'):
+    '''
+    This function marks the jobs a reload of a week changes, the week's own
+    and the season averages, as pending in every stage of the checkpoint
+    manifest, so the next run redoes them
+
+    PARAMETERS
+    ----------
+    year: {int} the NFL season year
+
+    week: {int} the week of the NFL season that was reloaded
+
+    manifest: {str} the path of the checkpoint manifest
+    '''
+    try:
+        with open(manifest) as f:
+            statuses = json.load(f)
+    except (IOError, ValueError):
+        return
+
+    prefixes = tuple('{}_{}_'.format(year, period)
+                     for period in [week, 'avg'])
+    for stage_statuses in statuses.values():
+        for key in stage_statuses:
+            if key.startswith(prefixes):
+                stage_statuses[key] = {'status': 'pending'}
+
+    _write_manifest(statuses, manifest)
+
+def _write_manifest(statuses, manifest):
+    # Write to a temporary file first so that a crash never leaves a
+    # partial manifest behind
+    directory = os.path.dirname(os.path.abspath(manifest))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(statuses, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest)
+
+def fit_job(job, cache=None):
+    '''
+    This function queries the data for a job, clusters the players by their
+    fantasy points, scales their stats and fits a ClutchMapper
+
+    PARAMETERS
+    ----------
+    job: {Job} the year, week and position
+
+    cache: {ClutchMapperCache} the cache to fit through, defaults to a new one
+
+    RETURNS
+    -------
+    cmapper: {ClutchMapper} the fitted ClutchMapper
+
+    names: {list} the names of the players
+    '''
+    from src.data_pipeline import query_avg, query_week
+    from src.cache import ClutchMapperCache
+
+    if job.week == 'avg':
+        df = query_avg(job.position, year=job.year)
+        points = 'avg_points'
+    else:
+        df = query_week(week=job.week, year=job.year, pos=job.position)
+        points = 'weekpts'
+
+    df = df.iloc[:MAX_PLAYERS]
+    names = list(df['name'].values)
+    X = df[points].values.reshape(-1,1)
+    with metrics.stage('cluster', n_players=len(names)):
+        agg = AgglomerativeClustering(n_clusters=N_SETS[job.position],
+                                      linkage='ward')
+        labels = agg.fit_predict(X)
+
+    stats = df.iloc[:,4:].values
+
+    scaler = StandardScaler()
+    scaled_stats = scaler.fit_transform(stats)
+
+    if cache is None:
+        cache = ClutchMapperCache()
+    with metrics.stage('ClutchMapper.fit', n_players=len(names)):
+        cmapper = cache.fit(scaled_stats, labels, end=THRESHOLDS.max())
+
+    return cmapper, names
+
+def _job_layouts(final_complexes):
+    '''
+    This function lays out the last observation and landmark complexes of a
+    job through the layout cache
+
+    PARAMETERS
+    ----------
+    final_complexes: {tuple} the observation and landmark complexes at the
+                     last threshold
+
+    RETURNS
+    -------
+    layouts: {dict} the Layout of the 'observer' and 'landmark' complexes
+    '''
+    from src.tda import LayoutCache
+    from src.cache import CACHE_DIR
+
+    layout_cache = LayoutCache(os.path.join(CACHE_DIR, 'layouts'))
+    layouts = {}
+    for kind, final_complex in zip(['observer', 'landmark'], final_complexes):
+        layouts[kind] = layout_cache.layout(final_complex)
+
+    return layouts
+
+def run_complexes(job):
+    '''
+    This function builds the observation and landmark complexes of a job at
+    every threshold, visualizes them and inserts the figures to MongoDB. Every
+    figure of a complex is drawn with the layout of its last, largest
+    complex, so the vertices stay put as the threshold changes.
+
+    PARAMETERS
+    ----------
+    job: {Job} the year, week and position
+    '''
+    from src.tda import visualize_complex, FigureWriter
+
+    cmapper, names = fit_job(job)
+    frames = list(cmapper.iter_complexes(THRESHOLDS))
+    layouts = _job_layouts(frames[-1][1:])
+
+    if job.week == 'avg':
+        title = '{} {} AVG: {{}} Complex at t={{}}'.format(job.year,
+                                                          job.position)
+        name = '{}_avg_{{}}_complex_{{}}_{}'.format(job.position.lower(),
+                                                    job.year)
+    else:
+        title = '{} {} Week {}: {{}} Complex at t={{}}'.format(job.year,
+                    job.position, job.week)
+        name = '{}_week_{}_{{}}_complex_{{}}_{}'.format(job.position.lower(),
+                                                        job.week, job.year)
+
+    with FigureWriter() as writer:
+        for i, observer_complex, landmark_complex in frames:
+            with metrics.tags(threshold=i):
+                with metrics.stage('visualize_complex', complex='observer',
+                                   n_simplices=len(observer_complex)):
+                    observer_fig = visualize_complex(
+                                       observer_complex,
+                                       title.format('Observer', i),
+                                       layout=layouts['observer'])
+                with metrics.stage('visualize_complex', complex='landmark',
+                                   n_simplices=len(landmark_complex)):
+                    landmark_fig = visualize_complex(
+                                       landmark_complex,
+                                       title.format('Landmark', i),
+                                       names, layouts['landmark'])
+
+                writer.write(observer_fig, name.format('observer', i))
+                writer.write(landmark_fig, name.format('landmark', i))
+
+def run_filtrations(job):
+    '''
+    This function inserts a single figure of the observation filtration and
+    one of the landmark filtration of a job to MongoDB, instead of a figure
+    per threshold. Each figure holds the simplices in the order they are
+    born, and the complex at a threshold is a prefix of them, see
+    visualize_filtration.
+
+    PARAMETERS
+    ----------
+    job: {Job} the year, week and position
+    '''
+    from src.tda import visualize_filtration, FigureWriter
+
+    cmapper, names = fit_job(job)
+    deltas = list(cmapper.iter_complexes(THRESHOLDS, delta=True))
+    # The last complexes are a prefix of the filtrations, so this is cheap
+    final_complexes = next(cmapper.iter_complexes([THRESHOLDS.max()]))[1:]
+    layouts = _job_layouts(final_complexes)
+
+    if job.week == 'avg':
+        title = '{} {} AVG: {{}} Filtration'.format(job.year, job.position)
+        name = '{}_avg_{{}}_filtration_{}'.format(job.position.lower(),
+                                                  job.year)
+    else:
+        title = '{} {} Week {}: {{}} Filtration'.format(job.year,
+                    job.position, job.week)
+        name = '{}_week_{}_{{}}_filtration_{}'.format(job.position.lower(),
+                                                      job.week, job.year)
+
+    with FigureWriter() as writer:
+        for kind, index, kind_names in [('Observer', 1, None),
+                                        ('Landmark', 2, names)]:
+            with metrics.stage('visualize_filtration', complex=kind.lower()):
+                fig = visualize_filtration([(delta[0], delta[index])
+                                            for delta in deltas],
+                                           title.format(kind), kind_names,
+                                           layouts[kind.lower()], THRESHOLDS)
+
+            writer.write(fig, name.format(kind.lower()))
+
+def run_barcodes(job, directory='plots'):
+    '''
+    This function plots the barcode diagrams for beta_0 of the observation and
+    landmark complexes of a job
+
+    PARAMETERS
+    ----------
+    job: {Job} the year, week and position
+
+    directory: {str} where to save the plots
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from src.barcodes import plot_bars
+
+    cmapper, names = fit_job(job)
+    diagrams = zip(['Observer', 'Landmark'], cmapper.zero_persistence())
+
+    if job.week == 'avg':
+        title = '{} {} AVG'.format(job.year, job.position)
+        filepath = os.path.join(directory, str(job.year), 'avg',
+                                '{}_avg_barcode_{{}}.png'.\
+                                    format(job.position.lower()))
+    else:
+        title = '{} {} Week {}'.format(job.year, job.position, job.week)
+        filepath = os.path.join(directory, str(job.year),
+                                'week{}'.format(job.week),
+                                '{}_barcode_{{}}.png'.\
+                                    format(job.position.lower()))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    for kind, diagram in diagrams:
+        barcode = plt.figure(figsize=(15,10))
+        plt.title("{}: Barcode Diagram for $\\beta_0$ of the {} Complex".\
+                      format(title, kind))
+        plot_bars(diagram)
+        barcode.savefig(filepath.format(kind.lower()))
+        plt.close(barcode)
+
+def run_store(job):
+    '''
+    This function stores the observation and landmark filtrations of a job,
+    their simplices, births and the player names, to MongoDB without
+    rendering any figure. A FigureRenderer draws the complex at any threshold
+    from them on demand.
+
+    PARAMETERS
+    ----------
+    job: {Job} the year, week and position
+    '''
+    from src.render import encode_filtrations, store_filtrations
+
+    cmapper, names = fit_job(job)
+    with metrics.stage('store_filtrations'):
+        store_filtrations([encode_filtrations(cmapper, names, *job)])
+
+STAGES = {'complexes': run_complexes, 'filtrations': run_filtrations,
+          'barcodes': run_barcodes, 'store': run_store}
+
+def _run(args):
+    '''
+    This function runs one job in a worker process and reports how it went
+    instead of raising, so one failed job does not stop the others
+    '''
+    stage, job = args
+    start = time()
+    try:
+        with metrics.tags(year=job.year, week=job.week,
+                          position=job.position), \
+                metrics.profile('{}_{}'.format(stage, job_key(job))):
+            with metrics.stage(stage):
+                STAGES[stage](job)
+    except Exception:
+        return job, {'status': 'failed', 'seconds': time() - start,
+                     'error': traceback.format_exc()}
+
+    return job, {'status': 'done', 'seconds': time() - start}
+
+class PipelineRunner:
+
+    def __init__(self, jobs, manifest='pipeline_manifest.json',
+                 stage='complexes', processes=None, force=False):
+        '''
+        The PipelineRunner object runs independent (year, week, position) jobs
+        on a process pool. Every finished job is written to a checkpoint
+        manifest, so running the same jobs again after a crash skips the ones
+        that are already done.
+
+        PARAMETERS
+        ----------
+        jobs: {list} the jobs to run, see expand_grid
+
+        manifest: {str} the path of the checkpoint manifest
+
+        stage: {str} 'complexes' to insert a figure of the complexes at each
+               threshold to MongoDB, 'filtrations' to insert a single figure
+               of each filtration, 'store' to store only the filtrations for
+               a FigureRenderer to render on demand, or 'barcodes' to plot
+               the barcode diagrams
+
+        processes: {int} the number of worker processes, defaults to the
+                   number of CPUs
+
+        force: {bool} whether to run the jobs again even if they are done,
+               e.g. after their data was reloaded
+        '''
+        self.jobs = list(jobs)
+        self.manifest = manifest
+        self.stage = stage
+        self.processes = processes or multiprocessing.cpu_count()
+        self.statuses_ = self._load_manifest()
+
+        if force:
+            for job in self.jobs:
+                self.statuses_[job_key(job)] = {'status': 'pending'}
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest) as f:
+                statuses = json.load(f).get(self.stage, {})
+        except (IOError, ValueError):
+            statuses = {}
+
+        for job in self.jobs:
+            statuses.setdefault(job_key(job), {'status': 'pending'})
+
+        return statuses
+
+    def _save_manifest(self):
+        try:
+            with open(self.manifest) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            manifest = {}
+        manifest[self.stage] = self.statuses_
+        _write_manifest(manifest, self.manifest)
+
+    def status(self, job=None):
+        '''
+        This method returns the status of the jobs
+
+        PARAMETERS
+        ----------
+        job: {Job} a single job, defaults to every job
+
+        RETURNS
+        -------
+        status: {dict} the status of the job, e.g. {'status': 'done',
+                'seconds': 12.3}, or a dict of them keyed by job_key
+        '''
+        if job is not None:
+            return self.statuses_[job_key(job)]
+
+        return {job_key(job): self.statuses_[job_key(job)]
+                for job in self.jobs}
+
+    def run(self, verbose=True):
+        '''
+        This method runs every job that is not done yet
+
+        PARAMETERS
+        ----------
+        verbose: {bool} whether to print each job as it finishes
+
+        RETURNS
+        -------
+        failed: {list} the jobs that failed
+        '''
+        pending = [job for job in self.jobs
+                   if self.statuses_[job_key(job)]['status'] != 'done']
+        for job in pending:
+            self.statuses_[job_key(job)] = {'status': 'running'}
+        self._save_manifest()
+
+        failed = []
+        with multiprocessing.Pool(processes=self.processes) as pool:
+            for job, status in pool.imap_unordered(
+                    _run, [(self.stage, job) for job in pending]):
+                self.statuses_[job_key(job)] = status
+                self._save_manifest()
+
+                if status['status'] == 'failed':
+                    failed.append(job)
+                if verbose:
+                    print("{} {} {} in {:.1f} seconds".format(self.stage,
+                              job_key(job), status['status'],
+                              status['seconds']))
+
+        return failed
+
+def _week(week):
+    return week if week == 'avg' else int(week)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the TDA pipeline over a grid of jobs')
+    parser.add_argument('--years', type=int, nargs='+', default=[2017])
+    parser.add_argument('--weeks', type=_week, nargs='+',
+                        default=list(range(1,18)) + ['avg'],
+                        help="weeks of the season, or 'avg' for the averages")
+    parser.add_argument('--positions', nargs='+', default=POSITIONS)
+    parser.add_argument('--stage', choices=sorted(STAGES),
+                        default='complexes')
+    parser.add_argument('--manifest', default='pipeline_manifest.json')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--force', action='store_true',
+                        help='run the jobs again even if they are done')
+    parser.add_argument('--metrics',
+                        help='a JSON lines file to record the stage timings to')
+    parser.add_argument('--metrics-memory', action='store_true',
+                        help='also record the peak memory of each stage, '
+                             'which slows the stages down')
+    parser.add_argument('--profile',
+                        help='a directory to dump the cProfile stats of each '
+                             'job to')
+    args = parser.parse_args()
+
+    if args.metrics is not None or args.profile is not None:
+        metrics.configure(args.metrics, args.profile, args.metrics_memory)
+
+    runner = PipelineRunner(expand_grid(args.years, args.weeks,
+                                        args.positions),
+                            args.manifest, args.stage, args.processes,
+                            args.force)
+    failed = runner.run()
+
+    if len(failed) > 0:
+        print("{} jobs failed, see {}".format(len(failed), args.manifest))
+        sys.exit(1)
@@ -0,0 +1,141 @@
+import os
+import shutil
+import hashlib
+import pandas as pd
+from src.storage import get_backend, _write_parquet
+from src import metrics
+
+# Bump when the layout of the cached results changes, so older files are
+# never read
+SCHEMA_VERSION = 1
+
+# CLUTCH_QUERY_CACHE is where the results are kept, or 'off' to run every
+# query. A load only invalidates the cache of the process that made it, so
+# turn the cache off, or clear it, when other processes or hosts write the
+# same database.
+QUERY_CACHE_DIR = os.environ.get('CLUTCH_QUERY_CACHE',
+                                 os.path.join(os.path.expanduser('~'),
+                                              '.cache', 'clutch', 'queries'))
+
+_query_cache = None
+
+class QueryCache:
+
+    def __init__(self, directory=QUERY_CACHE_DIR):
+        '''
+        The QueryCache object keeps the results of query_week and query_avg as
+        Parquet files, keyed by a hash of the query and the schema version and
+        filed under the (year, week) they read, so a load can remove exactly
+        the results it changes. The season averages are filed under a week
+        of 'avg'.
+
+        PARAMETERS
+        ----------
+        directory: {str} where to save the files, defaults to the
+                   CLUTCH_QUERY_CACHE environment variable or
+                   ~/.cache/clutch/queries, or 'off' or None to run every
+                   query
+        '''
+        self.directory = None if directory == 'off' else directory
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, year, week, q):
+        # Results from another backend or database are never served
+        digest = hashlib.sha1('{}\n{}\n{}'.format(SCHEMA_VERSION,
+                                                  get_backend().cache_key,
+                                                  q).encode())
+
+        return os.path.join(self.directory, 'year={}'.format(year),
+                            'week={}'.format(week),
+                            '{}.parquet'.format(digest.hexdigest()))
+
+    def read(self, year, week, q, run):
+        '''
+        This method returns the cached result of a query, running it and
+        caching the result when there is none
+
+        PARAMETERS
+        ----------
+        year: {int} the NFL season year the query reads
+
+        week: {int} the week the query reads, or 'avg' for the whole season
+
+        q: {str} the SQL query
+
+        run: {function} takes the query and returns its result
+
+        RETURNS
+        -------
+        df: {pandas.DataFrame} the result
+        '''
+        if self.directory is None:
+            return run(q)
+
+        path = self._path(year, week, q)
+
+        if os.path.exists(path):
+            self.hits += 1
+            metrics.count('query_cache_hit')
+            return pd.read_parquet(path)
+
+        self.misses += 1
+        metrics.count('query_cache_miss')
+        df = run(q)
+        _write_parquet(df, path)
+
+        return df
+
+    def invalidate(self, year, week):
+        '''
+        This method removes the cached results a load of a week changes, the
+        week's own and the season averages
+
+        PARAMETERS
+        ----------
+        year: {int} the NFL season year
+
+        week: {int} the week of the NFL season
+        '''
+        if self.directory is None:
+            return
+
+        for period in [week, 'avg']:
+            shutil.rmtree(os.path.join(self.directory, 'year={}'.format(year),
+                                       'week={}'.format(period)),
+                          ignore_errors=True)
+
+    def clear(self):
+        '''
+        This method removes every cached result
+        '''
+        if self.directory is None:
+            return
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        '''
+        This method counts the cache hits and misses of this process
+
+        RETURNS
+        -------
+        stats: {dict} the hits and misses
+        '''
+        return {'hits': self.hits, 'misses': self.misses}
+
+def get_query_cache():
+    '''
+    This function returns the QueryCache shared by the queries, creating it on
+    first use
+
+    RETURNS
+    -------
+    query_cache: {QueryCache}
+    '''
+    global _query_cache
+
+    if _query_cache is None:
+        _query_cache = QueryCache()
+
+    return _query_cache
@@ -0,0 +1,320 @@
+import os
+import sys
+module_path = os.path.abspath(os.path.join('..'))
+if module_path not in sys.path:
+    sys.path.append(module_path)
+import threading
+from collections import OrderedDict
+from src.simplicial import SimplicialComplex, Filtration
+from src.tda import db_name, visualize_complex, compute_layout
+from src.documents import encode_value, decode_value, to_gridfs, \
+                          from_gridfs, gridfs_files, delete_gridfs
+
+collection_name = 'filtrations'
+_filtrations = None
+
+def get_filtrations():
+    '''
+    This function connects to MongoDB on first use and makes sure the stored
+    filtrations are indexed by name
+
+    RETURNS
+    -------
+    filtrations: {pymongo.collection.Collection} the collection of
+                 filtrations
+    '''
+    global _filtrations
+
+    if _filtrations is None:
+        import pymongo
+
+        client = pymongo.MongoClient()
+        _filtrations = client[db_name][collection_name]
+        _filtrations.create_index([('name', pymongo.ASCENDING)], unique=True)
+
+    return _filtrations
+
+def filtration_name(year, week, position):
+    '''
+    This function names the filtrations of a position in a week, e.g.
+    qb_week_1_2017, or qb_avg_2017 for the season averages
+    '''
+    if week == 'avg':
+        return '{}_avg_{}'.format(position.lower(), year)
+
+    return '{}_week_{}_{}'.format(position.lower(), week, year)
+
+def encode_filtrations(cmapper, names, year, week, position):
+    '''
+    This function turns the filtrations of a fitted ClutchMapper into the
+    document stored in MongoDB. Only the simplices, their births and the
+    player names are kept, the figures are rendered from them on demand.
+
+    PARAMETERS
+    ----------
+    cmapper: {ClutchMapper} a ClutchMapper with its filtrations built
+
+    names: {list} the name of each landmark
+
+    year: {int} the NFL season year
+
+    week: {int} the week of the NFL season, or 'avg' for the averages
+
+    position: {str} the position
+
+    RETURNS
+    -------
+    doc: {dict} the document, with the large arrays zlib compressed
+    '''
+    doc = {'name': filtration_name(year, week, position), 'year': year,
+           'week': week, 'position': position, 'names': list(names),
+           'k': cmapper.filtration_params_[0],
+           'end': float(cmapper.filtration_params_[1])}
+
+    for kind, filtration in [('observer', cmapper.observer_filtration_),
+                             ('landmark', cmapper.landmark_filtration_)]:
+        doc[kind] = {'simplices': filtration.simplices,
+                     'births': filtration.births}
+
+    return encode_value(doc)
+
+def decode_filtrations(doc):
+    '''
+    This function turns a stored document back into filtrations
+
+    PARAMETERS
+    ----------
+    doc: {dict} the document
+
+    RETURNS
+    -------
+    filtrations: {dict} the 'observer' and 'landmark' Filtration, the
+                 'names' of the landmarks and the rest of the document
+    '''
+    doc = decode_value(doc)
+    filtrations = {key: value for key, value in doc.items() if key != '_id'}
+
+    # Small arrays come back as lists, which Filtration reshapes
+    for kind in ['observer', 'landmark']:
+        filtrations[kind] = Filtration(doc[kind]['simplices'],
+                                       doc[kind]['births'])
+
+    return filtrations
+
+def store_filtrations(docs, collection=None):
+    '''
+    This function upserts filtration documents by name in one unordered bulk
+    write, so storing the same week again is safe. Documents too big for BSON
+    go to GridFS, like the figures of a FigureWriter.
+
+    PARAMETERS
+    ----------
+    docs: {list} documents from encode_filtrations
+
+    collection: {pymongo.collection.Collection} where to store them, defaults
+                to the filtrations collection
+
+    RETURNS
+    -------
+    result: {pymongo.results.BulkWriteResult}
+    '''
+    from pymongo import ReplaceOne
+
+    if collection is None:
+        collection = get_filtrations()
+
+    docs = [to_gridfs(doc, collection) for doc in docs]
+    # The GridFS files of the filtrations about to be replaced
+    old_files = gridfs_files(collection, [doc['name'] for doc in docs])
+
+    result = collection.bulk_write([ReplaceOne({'name': doc['name']}, doc,
+                                               upsert=True) for doc in docs],
+                                   ordered=False)
+    delete_gridfs(collection, old_files)
+
+    return result
+
+class _LRUCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+
+        return item
+
+    def put(self, key, item):
+        '''
+        Keeps the item already cached under the key if another thread put one
+        first, and returns whichever is cached
+        '''
+        item = self._items.setdefault(key, item)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+        return item
+
+class FigureRenderer:
+
+    def __init__(self, collection=None, max_filtrations=64, max_figures=256):
+        '''
+        The FigureRenderer object renders the figure of a complex at any
+        threshold from the stored filtrations, e.g. for a web app. The
+        filtrations, their layouts and the rendered figures are kept in LRU
+        caches, and every threshold of a filtration is drawn with the layout
+        of its last complex so the vertices stay put. It is safe to share
+        between threads: the caches are only locked to read and update them,
+        never while a filtration is loaded, laid out or drawn.
+
+        PARAMETERS
+        ----------
+        collection: {pymongo.collection.Collection} where the filtrations are
+                    stored, defaults to the filtrations collection
+
+        max_filtrations: {int} the number of filtrations kept in memory
+
+        max_figures: {int} the number of figures kept in memory
+        '''
+        self.collection = collection
+        self.hits = 0
+        self.misses = 0
+        self._filtrations = _LRUCache(max_filtrations)
+        self._layouts = _LRUCache(2*max_filtrations)
+        self._figures = _LRUCache(max_figures)
+        self._lock = threading.Lock()
+
+    def filtrations(self, year, week, position):
+        '''
+        This method loads the filtrations of a position in a week
+
+        PARAMETERS
+        ----------
+        year: {int} the NFL season year
+
+        week: {int} the week of the NFL season, or 'avg' for the averages
+
+        position: {str} the position
+
+        RETURNS
+        -------
+        filtrations: {dict} see decode_filtrations
+
+        RAISES
+        ------
+        KeyError: when the filtrations were not stored
+        '''
+        name = filtration_name(year, week, position)
+
+        with self._lock:
+            filtrations = self._filtrations.get(name)
+        if filtrations is not None:
+            return filtrations
+
+        if self.collection is None:
+            self.collection = get_filtrations()
+        doc = self.collection.find_one({'name': name})
+        if doc is None:
+            raise KeyError('No filtrations stored for {}'.format(name))
+
+        filtrations = decode_filtrations(from_gridfs(doc, self.collection))
+        with self._lock:
+            return self._filtrations.put(name, filtrations)
+
+    def layout(self, year, week, position, kind):
+        '''
+        This method returns the layout every threshold of a filtration is
+        drawn with, the layout of its last complex
+
+        PARAMETERS
+        ----------
+        year: {int} the NFL season year
+
+        week: {int} the week of the NFL season, or 'avg' for the averages
+
+        position: {str} the position
+
+        kind: {str} 'observer' or 'landmark'
+
+        RETURNS
+        -------
+        layout: {Layout}
+        '''
+        key = (filtration_name(year, week, position), kind)
+
+        with self._lock:
+            layout = self._layouts.get(key)
+        if layout is not None:
+            return layout
+
+        filtration = self.filtrations(year, week, position)[kind]
+        layout = compute_layout(SimplicialComplex(filtration.simplices))
+        with self._lock:
+            return self._layouts.put(key, layout)
+
+    def render(self, year, week, position, kind, p):
+        '''
+        This method returns the figure of a complex at a threshold
+
+        PARAMETERS
+        ----------
+        year: {int} the NFL season year
+
+        week: {int} the week of the NFL season, or 'avg' for the averages
+
+        position: {str} the position
+
+        kind: {str} 'observer' or 'landmark'
+
+        p: {float} the visibility threshold
+
+        RETURNS
+        -------
+        fig: {plotly.graph_objs.Figure} a new figure on every call, so
+             callers can update it freely
+        '''
+        import plotly.graph_objs as go
+
+        key = (filtration_name(year, week, position), kind, float(p))
+
+        # The figures are cached as dicts, which are never handed out
+        with self._lock:
+            fig_dict = self._figures.get(key)
+            if fig_dict is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if fig_dict is not None:
+            return go.Figure(fig_dict)
+
+        filtrations = self.filtrations(year, week, position)
+        layout = self.layout(year, week, position, kind)
+
+        if week == 'avg':
+            title = '{} {} AVG: {} Complex at t={}'.format(year, position,
+                                                          kind.title(), p)
+        else:
+            title = '{} {} Week {}: {} Complex at t={}'.format(year,
+                        position, week, kind.title(), p)
+        names = filtrations['names'] if kind == 'landmark' else None
+
+        fig = visualize_complex(filtrations[kind].complex_at(p), title, names,
+                                layout)
+        with self._lock:
+            fig_dict = self._figures.put(key, fig.to_dict())
+
+        return go.Figure(fig_dict)
+
+    def stats(self):
+        '''
+        This method counts the figure cache hits and misses
+
+        RETURNS
+        -------
+        stats: {dict} the hits and misses
+        '''
+        return {'hits': self.hits, 'misses': self.misses}
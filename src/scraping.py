@@ -0,0 +1,185 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, monotonic
+from urllib.parse import urlsplit
+
+# Responses worth asking for again, e.g. when the server is overloaded
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_client = None
+
+class RateLimiter:
+
+    def __init__(self, rate=5.):
+        '''
+        The RateLimiter object spaces out the requests to each host so that
+        no host sees more than rate requests per second, however many threads
+        share it.
+
+        PARAMETERS
+        ----------
+        rate: {float} the most requests per second to each host, or None for
+              no limit
+        '''
+        self.rate = rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        '''
+        This method blocks until the host of the url may be sent another
+        request
+
+        PARAMETERS
+        ----------
+        url: {str} the url about to be requested
+        '''
+        if not self.rate:
+            return
+
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + 1. / self.rate
+
+        # Sleep outside of the lock so other hosts are not held up
+        if start > now:
+            sleep(start - now)
+
+class ScrapingClient:
+
+    def __init__(self, max_workers=8, rate=5., retries=3, backoff=0.5,
+                 timeout=10.):
+        '''
+        The ScrapingClient object shares one pooled HTTP session between the
+        scrapers. It fetches many pages at once on a thread pool, limits the
+        requests per second to each host and retries failed requests with
+        exponential backoff.
+
+        PARAMETERS
+        ----------
+        max_workers: {int} the most requests in flight at once
+
+        rate: {float} the most requests per second to each host, or None for
+              no limit
+
+        retries: {int} how many times to retry a failed request
+
+        backoff: {float} the seconds to wait before the first retry, doubling
+                 after each one
+
+        timeout: {float} the seconds to wait for the server to respond
+        '''
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+
+        # Keep a connection open to each host for every worker
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, params=None):
+        '''
+        This method sends a GET request, retrying connection errors, timeouts
+        and overloaded servers
+
+        PARAMETERS
+        ----------
+        url: {str} the url to request
+
+        params: {dict} the query string parameters
+
+        RETURNS
+        -------
+        response: {requests.Response} a successful response
+
+        RAISES
+        ------
+        requests.RequestException: when the request still fails after the
+                                   last retry, or the server refuses it
+        '''
+        import requests
+
+        for attempt in range(self.retries + 1):
+            self.limiter.wait(url)
+            try:
+                response = self.session.get(url, params=params,
+                                            timeout=self.timeout)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(
+                            '{} Server Error for url: {}'.\
+                                format(response.status_code, response.url),
+                            response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt < self.retries:
+                sleep(self.backoff * 2**attempt)
+
+        raise error
+
+    def map(self, fetch, weeks):
+        '''
+        This method runs a scraper for many weeks at once on the thread pool
+
+        PARAMETERS
+        ----------
+        fetch: {function} takes the week, year and this client, and returns
+               the scraped data
+
+        weeks: {list} (week, year) tuples
+
+        RETURNS
+        -------
+        results: {dict} the scraped data of each (week, year) that succeeded
+
+        errors: {dict} the exception of each (week, year) that failed
+        '''
+        weeks = list(weeks)
+        results = {}
+        errors = {}
+
+        def run(week_year):
+            week, year = week_year
+            try:
+                return week_year, fetch(week, year, self), None
+            except Exception as e:
+                return week_year, None, e
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for week_year, result, error in executor.map(run, weeks):
+                if error is None:
+                    results[week_year] = result
+                else:
+                    errors[week_year] = error
+
+        return results, errors
+
+    def close(self):
+        self.session.close()
+
+def get_client():
+    '''
+    This function returns the ScrapingClient shared by the scrapers, creating
+    it on first use
+
+    RETURNS
+    -------
+    client: {ScrapingClient}
+    '''
+    global _client
+
+    if _client is None:
+        _client = ScrapingClient()
+
+    return _client
@@ -0,0 +1,158 @@
+import os
+import sys
+module_path = os.path.abspath(os.path.join('..'))
+if module_path not in sys.path:
+    sys.path.append(module_path)
+import numpy as np
+import pandas as pd
+from src.storage import get_backend, TOTAL_COLUMNS
+
+# The names query_avg gives the averages of the stats that do not follow the
+# avg_<stat> pattern
+AVG_NAMES = {'weekpts': 'avg_points',
+             'two_point_conversions': 'avg_2_point_conversions'}
+
+class SeasonStats:
+
+    def __init__(self, year=2017, n_weeks=17):
+        '''
+        The SeasonStats object loads the weekly stats of a season once into a
+        (players x weeks x stats) array and keeps their cumulative sums and
+        appearance counts, so the average over any range of weeks is a
+        difference of two slices instead of a query. Like query_avg, a player
+        is counted separately at each position they played.
+
+        PARAMETERS
+        ----------
+        year: {int} the NFL season year
+
+        n_weeks: {int} the number of weeks in the season
+        '''
+        self.year = year
+        self.n_weeks = n_weeks
+
+    def load(self):
+        '''
+        This method queries the weekly stats of the season from the storage
+        backend
+
+        RETURNS
+        -------
+        self
+        '''
+        q = '''
+        SELECT id, name, position, week, {}
+        FROM fantasy
+        WHERE year = {};
+        '''.format(', '.join(TOTAL_COLUMNS), self.year)
+
+        return self.fit(get_backend().query(q))
+
+    def fit(self, df):
+        '''
+        This method builds the cumulative sums and counts from weekly stats
+
+        PARAMETERS
+        ----------
+        df: {pandas.DataFrame} a row for each player and week, with the id,
+            name, position, week and TOTAL_COLUMNS of the fantasy table
+
+        RETURNS
+        -------
+        self
+        '''
+        df = df[(df['week'] >= 1) & (df['week'] <= self.n_weeks)]
+
+        players = df[['id', 'position']].drop_duplicates()
+        index = pd.MultiIndex.from_frame(players)
+        rows = index.get_indexer(pd.MultiIndex.from_frame(
+                                     df[['id', 'position']]))
+        weeks = df['week'].values.astype(int) - 1
+
+        # The name of the latest week each player played
+        names = df.sort_values('week').drop_duplicates(['id', 'position'],
+                                                       keep='last')
+        names = names.set_index(['id', 'position'])['name']
+
+        self.ids_ = players['id'].values
+        self.positions_ = players['position'].values
+        self.names_ = names.reindex(index).values
+
+        values = np.zeros((len(players), self.n_weeks, len(TOTAL_COLUMNS)))
+        values[rows, weeks] = df[TOTAL_COLUMNS].fillna(0).values
+        played = np.zeros((len(players), self.n_weeks))
+        played[rows, weeks] = 1
+
+        # A leading week of zeros makes weeks start through end the
+        # difference cumsum[:, end] - cumsum[:, start - 1]
+        self.cumsum_ = np.zeros((len(players), self.n_weeks + 1,
+                                 len(TOTAL_COLUMNS)))
+        np.cumsum(values, axis=1, out=self.cumsum_[:, 1:])
+        self.counts_ = np.zeros((len(players), self.n_weeks + 1))
+        np.cumsum(played, axis=1, out=self.counts_[:, 1:])
+
+        return self
+
+    def average(self, pos='QB', end=None, start=1):
+        '''
+        This method averages the stats of the players at a position over
+        weeks start through end
+
+        PARAMETERS
+        ----------
+        pos: {str} the position, or None for every position
+
+        end: {int} the last week, defaults to the last week of the season
+
+        start: {int} the first week
+
+        RETURNS
+        -------
+        {pandas.DataFrame} a DataFrame with the columns of query_avg
+        '''
+        if end is None:
+            end = self.n_weeks
+
+        start = max(start, 1)
+        end = min(end, self.n_weeks)
+
+        counts = self.counts_[:, end] - self.counts_[:, start - 1]
+        mask = counts > 0
+        if pos is not None:
+            mask &= self.positions_ == pos
+
+        sums = self.cumsum_[mask, end] - self.cumsum_[mask, start - 1]
+        averages = sums / counts[mask, np.newaxis]
+
+        df = pd.DataFrame(averages,
+                          columns=[AVG_NAMES.get(column, 'avg_' + column)
+                                   for column in TOTAL_COLUMNS])
+        df.insert(0, 'id', self.ids_[mask])
+        df.insert(1, 'name', self.names_[mask])
+        df.insert(2, 'pos', self.positions_[mask])
+
+        return df.sort_values('avg_points', ascending=False).\
+                  reset_index(drop=True)
+
+    def rolling(self, weeks=4, pos='QB', end=None):
+        '''
+        This method averages the stats of the players at a position over the
+        last few weeks
+
+        PARAMETERS
+        ----------
+        weeks: {int} the number of weeks in the window
+
+        pos: {str} the position, or None for every position
+
+        end: {int} the last week of the window, defaults to the last week of
+             the season
+
+        RETURNS
+        -------
+        {pandas.DataFrame} a DataFrame with the columns of query_avg
+        '''
+        if end is None:
+            end = self.n_weeks
+
+        return self.average(pos, end=end, start=end - weeks + 1)
@@ -0,0 +1,287 @@
+import numpy as np
+
+class SimplicialComplex:
+
+    def __init__(self, simplices):
+        '''
+        The SimplicialComplex object stores the simplices of each dimension as
+        a contiguous int32 array of vertices, so a 2-simplex costs 12 bytes
+        instead of a Python list of Python ints. Iterating over it yields the
+        simplices as lists, dimension by dimension, just like the lists of
+        lists that ClutchMapper.build_complex used to return.
+
+        PARAMETERS
+        ----------
+        simplices: {list} for each dimension, a (m, dimension+1) array of
+                   simplices
+        '''
+        self.simplices = [np.asarray(dim_simplices, dtype=np.int32).\
+                              reshape(-1, dim+1)
+                          for dim, dim_simplices in enumerate(simplices)]
+
+    @classmethod
+    def from_list(cls, simplicial_complex):
+        '''
+        This method builds a SimplicialComplex from a list of lists containing
+        the simplices
+
+        PARAMETERS
+        ----------
+        simplicial_complex: {list} a list containing simplices of the complex
+
+        RETURNS
+        -------
+        simplicial_complex: {SimplicialComplex}
+        '''
+        if isinstance(simplicial_complex, cls):
+            return simplicial_complex
+
+        k = max([len(simplex) for simplex in simplicial_complex] or [1]) - 1
+        simplices = [[] for dim in range(k+1)]
+        for simplex in simplicial_complex:
+            simplices[len(simplex)-1].append(simplex)
+
+        return cls(simplices)
+
+    @property
+    def k(self):
+        '''
+        The highest dimension of the complex
+        '''
+        return len(self.simplices) - 1
+
+    @property
+    def vertices(self):
+        '''
+        An array of the vertices of the complex
+        '''
+        return self.dimension(0).ravel()
+
+    @property
+    def nbytes(self):
+        '''
+        The number of bytes used by the simplices
+        '''
+        return sum(dim_simplices.nbytes for dim_simplices in self.simplices)
+
+    def dimension(self, dim):
+        '''
+        This method returns the simplices of a single dimension
+
+        PARAMETERS
+        ----------
+        dim: {int} the dimension of the simplices
+
+        RETURNS
+        -------
+        simplices: {array} a (m, dim+1) array of simplices
+        '''
+        if dim < len(self.simplices):
+            return self.simplices[dim]
+
+        return np.empty((0, dim+1), dtype=np.int32)
+
+    def skeleton(self, k):
+        '''
+        This method returns the simplices up to dimension k
+
+        PARAMETERS
+        ----------
+        k: {int} the highest dimension of the skeleton
+
+        RETURNS
+        -------
+        skeleton: {SimplicialComplex}
+        '''
+        return SimplicialComplex(self.simplices[:k+1])
+
+    def sorted(self):
+        '''
+        This method returns the complex with the simplices of each dimension
+        in lexicographic order, the order ClutchMapper.build_complex returns
+
+        RETURNS
+        -------
+        simplicial_complex: {SimplicialComplex}
+        '''
+        # lexsort sorts by its last key first, so the vertices go in reversed
+        return SimplicialComplex([dim_simplices[np.lexsort(
+                                      dim_simplices.T[::-1])]
+                                  for dim_simplices in self.simplices])
+
+    def tolist(self):
+        '''
+        RETURNS
+        -------
+        simplicial_complex: {list} a list of lists containing the simplices
+        '''
+        return list(self)
+
+    def __len__(self):
+        return sum(dim_simplices.shape[0] for dim_simplices in self.simplices)
+
+    def __iter__(self):
+        for dim_simplices in self.simplices:
+            for simplex in dim_simplices.tolist():
+                yield simplex
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                    ', '.join('{}-simplices: {}'.format(dim, len(s))
+                              for dim, s in enumerate(self.simplices)))
+
+class Filtration(SimplicialComplex):
+
+    def __init__(self, simplices, births):
+        '''
+        The Filtration object stores the simplices of each dimension as a
+        contiguous int32 array of vertices along with a float array of the
+        visibility thresholds they are born at. Within each dimension the
+        simplices are sorted by birth, so the complex at any threshold is a
+        prefix of every dimension. Iterating over it yields (simplex, birth)
+        tuples sorted by birth, then by dimension so that faces always come
+        before their cofaces.
+
+        PARAMETERS
+        ----------
+        simplices: {list} for each dimension, a (m, dimension+1) array of
+                   simplices
+
+        births: {list} for each dimension, an array of the births of the
+                simplices
+        '''
+        super().__init__(simplices)
+        births = [np.asarray(dim_births, dtype=float) for dim_births in births]
+
+        self.births = []
+        for dim, dim_births in enumerate(births):
+            order = np.argsort(dim_births, kind='mergesort')
+            self.simplices[dim] = self.simplices[dim][order]
+            self.births.append(dim_births[order])
+
+    @property
+    def end(self):
+        '''
+        The birth of the last simplex of the filtration
+        '''
+        return max([dim_births[-1] for dim_births in self.births
+                    if dim_births.shape[0] > 0] or [0.])
+
+    @property
+    def nbytes(self):
+        '''
+        The number of bytes used by the simplices and their births
+        '''
+        return super().nbytes + sum(b.nbytes for b in self.births)
+
+    def dimension_births(self, dim):
+        '''
+        This method returns the births of the simplices of a single dimension
+
+        PARAMETERS
+        ----------
+        dim: {int} the dimension of the simplices
+
+        RETURNS
+        -------
+        births: {array} the birth of each simplex
+        '''
+        if dim < len(self.births):
+            return self.births[dim]
+
+        return np.empty(0)
+
+    def complex_at(self, p):
+        '''
+        This method returns the simplicial complex at a visibility threshold,
+        which holds every simplex born before it
+
+        PARAMETERS
+        ----------
+        p: {float} the visibility threshold
+
+        RETURNS
+        -------
+        simplicial_complex: {SimplicialComplex}
+        '''
+        return self.born_between(-np.inf, p)
+
+    def born_between(self, start, stop):
+        '''
+        This method returns the simplices born in [start, stop), e.g. the
+        simplices added between two visibility thresholds
+
+        PARAMETERS
+        ----------
+        start: {float} the smallest birth
+
+        stop: {float} the visibility threshold the simplices are born before
+
+        RETURNS
+        -------
+        simplicial_complex: {SimplicialComplex}
+        '''
+        simplices = []
+        for dim_simplices, dim_births in zip(self.simplices, self.births):
+            lo, hi = np.searchsorted(dim_births, [start, stop], side='left')
+            simplices.append(dim_simplices[lo:hi])
+
+        return SimplicialComplex(simplices)
+
+    def skeleton(self, k):
+        '''
+        This method returns the filtration of the simplices up to dimension k
+
+        PARAMETERS
+        ----------
+        k: {int} the highest dimension of the skeleton
+
+        RETURNS
+        -------
+        skeleton: {Filtration}
+        '''
+        return Filtration(self.simplices[:k+1], self.births[:k+1])
+
+    def order(self):
+        '''
+        This method sorts the simplices of every dimension together by birth,
+        then by dimension
+
+        RETURNS
+        -------
+        dimensions: {array} the dimension of each simplex in order
+
+        indices: {array} the index of each simplex within its dimension
+        '''
+        dimensions = np.concatenate([np.full(dim_births.shape[0], dim)
+                                     for dim, dim_births in enumerate(self.births)])
+        indices = np.concatenate([np.arange(dim_births.shape[0])
+                                  for dim_births in self.births])
+        order = np.lexsort((dimensions, np.concatenate(self.births)))
+
+        return dimensions[order], indices[order]
+
+    def to_dionysus(self):
+        '''
+        This method converts the filtration to a dionysus Filtration, e.g. to
+        compute its persistent homology
+
+        RETURNS
+        -------
+        filtration {dionysus.Filtration} a filtration of simplicial complices
+        '''
+        import dionysus as d
+
+        # The simplices are already sorted by the visibility threshold they
+        # were born at, so the filtration does not need to be sorted
+        filtration = d.Filtration()
+        for simplex, p in self:
+            filtration.append(d.Simplex(simplex, p))
+
+        return filtration
+
+    def __iter__(self):
+        simplices = [dim_simplices.tolist() for dim_simplices in self.simplices]
+        births = [dim_births.tolist() for dim_births in self.births]
+        for dim, i in zip(*self.order()):
+            yield simplices[dim][i], births[dim][i]
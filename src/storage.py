@@ -0,0 +1,664 @@
+import os
+import io
+import tempfile
+from glob import glob
+import pandas as pd
+
+# The columns that identify a row of each table
+TABLE_KEYS = {'fantasy': ['id', 'week', 'year'],
+              'draftkings': ['gid', 'week', 'year'],
+              'fantasy_totals': ['year', 'position', 'id']}
+
+# The columns the Parquet files of each table are partitioned by, and that
+# the Postgres tables are indexed on
+PARTITIONS = {'fantasy': ['year', 'week', 'position'],
+              'draftkings': ['year', 'week', 'pos'],
+              'fantasy_totals': ['year', 'position']}
+
+# The running totals of each player's season are kept in fantasy_totals
+TOTALS = {'fantasy': 'fantasy_totals'}
+
+# The stats summed in the totals, which query_avg averages
+TOTAL_COLUMNS = ['weekpts', 'passing_attempts', 'passing_completions',
+                 'incomplete_passes', 'passing_yards', 'passing_touchdowns',
+                 'interceptions_thrown', 'every_time_sacked',
+                 'rushing_attempts', 'rushing_yards', 'rushing_touchdowns',
+                 'receptions', 'receiving_yards', 'receiving_touchdowns',
+                 'kickoff_and_punt_return_yards',
+                 'kickoff_and_punt_return_touchdowns',
+                 'fumble_recovered_for_td', 'fumbles_lost', 'fumble',
+                 'two_point_conversions', 'pat_made', 'pat_missed',
+                 'fg_made_0_19', 'fg_made_20_29', 'fg_made_30_39',
+                 'fg_made_40_49', 'fg_made_50plus', 'fg_missed_0_19',
+                 'fg_missed_20_29', 'fg_missed_30_39', 'fg_missed_40_49',
+                 'fg_missed_50plus', 'sacks', 'interceptions',
+                 'fumbles_recovered', 'fumbles_forced', 'safeties',
+                 'touchdowns', 'blocked_kicks', 'points_allowed',
+                 'yards_allowed', 'tackle', 'assisted_tackles', 'sack',
+                 'defense_interception', 'forced_fumble', 'fumbles_recovery',
+                 'touchdown_interception_return', 'touchdown_fumble_return',
+                 'touchdown_blocked_kick', 'blocked_kick_punt_fg_pat',
+                 'safety', 'pass_defended', 'interception_return_yards',
+                 'fumble_return_yards', 'qb_hit', 'sack_yards',
+                 'def_2_point_return', 'team_def_2_point_return']
+
+# CLUTCH_STORAGE picks the backend, 'postgres' or 'parquet', and CLUTCH_DATA
+# where the Parquet backend keeps its files
+STORAGE = os.environ.get('CLUTCH_STORAGE', 'postgres')
+DATA_DIR = os.environ.get('CLUTCH_DATA',
+                          os.path.join(os.path.expanduser('~'), '.local',
+                                       'share', 'clutch'))
+
+_engine = None
+_backend = None
+
+def get_engine():
+    '''
+    This function connects to the Postgres database on first use, so the
+    credentials are only needed by code that actually reads or writes it
+
+    RETURNS
+    -------
+    engine: {sqlalchemy.engine.Engine} the engine of the nfl database
+    '''
+    global _engine
+
+    if _engine is None:
+        from sqlalchemy import create_engine
+
+        # DATABASE_URL points the pipeline at another database, e.g. a local
+        # Postgres instance
+        url = os.environ.get('DATABASE_URL')
+        if url is None:
+            url = "postgresql+psycopg2://{}:{}@{}/nfl"\
+                    .format(os.environ['CLUTCH_USR'],
+                            os.environ['CLUTCH_PWD'],
+                            os.environ['AWS_RDS'])
+
+        _engine = create_engine(url)
+
+    return _engine
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def _ensure_indexes(cursor, table_name):
+    '''
+    This function adds the unique index the upsert needs to a table, first
+    deleting the duplicate rows that earlier appends left behind, and the
+    index on the columns the queries filter by
+
+    PARAMETERS
+    ----------
+    cursor: {psycopg2.extensions.cursor} a cursor inside the load's
+            transaction
+
+    table_name: {str} table name
+    '''
+    keys = TABLE_KEYS[table_name]
+    index_name = '{}_{}_key'.format(table_name, '_'.join(keys))
+
+    cursor.execute("SELECT to_regclass(%s);", (_quote(index_name),))
+    if cursor.fetchone()[0] is None:
+        # Keep the most recently inserted copy of each row
+        cursor.execute('''
+        DELETE FROM {table} a
+        USING {table} b
+        WHERE a.ctid < b.ctid
+        AND {matches};
+        '''.format(table=_quote(table_name),
+                   matches=' AND '.join('a.{0} = b.{0}'.format(_quote(key))
+                                        for key in keys)))
+
+        cursor.execute("CREATE UNIQUE INDEX {} ON {} ({});".\
+                           format(_quote(index_name), _quote(table_name),
+                                  ', '.join(map(_quote, keys))))
+
+    columns = PARTITIONS[table_name]
+    cursor.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({});".\
+                       format(_quote('{}_{}_idx'.format(table_name,
+                                                         '_'.join(columns))),
+                              _quote(table_name),
+                              ', '.join(map(_quote, columns))))
+
+def _totals_query(table_name, where=''):
+    '''
+    This function writes the query that sums each player's stats over the
+    weeks of a season
+
+    PARAMETERS
+    ----------
+    table_name: {str} the table of weekly stats
+
+    where: {str} a WHERE clause picking the rows to sum
+
+    RETURNS
+    -------
+    q: {str} the query
+    '''
+    sums = ',\n'.join('SUM({0})::double precision AS {0}'.format(_quote(column))
+                      for column in TOTAL_COLUMNS)
+
+    return '''
+    SELECT year, position, id, MAX(name) AS name, COUNT(*) AS weeks,
+    {}
+    FROM {} {}
+    GROUP BY year, position, id
+    '''.format(sums, _quote(table_name), where)
+
+def _update_totals(cursor, table_name):
+    '''
+    This function brings the running totals up to date with the rows of a
+    load, recomputing only the players in the staging table. The first load
+    builds the totals from the whole table.
+
+    PARAMETERS
+    ----------
+    cursor: {psycopg2.extensions.cursor} a cursor inside the load's
+            transaction, after the staging table was merged
+
+    table_name: {str} the table of weekly stats
+    '''
+    totals = TOTALS[table_name]
+
+    cursor.execute("SELECT to_regclass(%s);", (_quote(totals),))
+    if cursor.fetchone()[0] is None:
+        cursor.execute("CREATE TABLE {} AS {};".format(
+                           _quote(totals), _totals_query(table_name)))
+        _ensure_indexes(cursor, totals)
+        return
+
+    cursor.execute('''
+    DELETE FROM {totals} t
+    USING affected a
+    WHERE t.year = a.year
+    AND t.position = a.position
+    AND t.id = a.id;
+    '''.format(totals=_quote(totals)))
+
+    cursor.execute("INSERT INTO {} {};".format(
+                       _quote(totals),
+                       _totals_query(table_name,
+                                     '''WHERE (year, position, id) IN
+                                     (SELECT year, position, id
+                                      FROM affected)''')))
+
+class PostgresBackend:
+
+    def __init__(self, engine=None):
+        '''
+        The PostgresBackend object keeps the tables in the Postgres nfl
+        database
+
+        PARAMETERS
+        ----------
+        engine: {sqlalchemy.engine.Engine} the engine of the database,
+                defaults to the one from get_engine
+        '''
+        self._engine = engine
+        self._totals_ready = set()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = get_engine()
+
+        return self._engine
+
+    @property
+    def cache_key(self):
+        '''
+        The backend and the database it reads, without the password, which
+        the query cache keys its results by
+        '''
+        return 'postgres:{!r}'.format(self.engine.url)
+
+    def write(self, df, table_name):
+        '''
+        This method upserts rows into a table. The rows are streamed with COPY
+        into a staging table and merged into the table in one transaction.
+
+        PARAMETERS
+        ----------
+        df: {pandas.DataFrame} the rows
+
+        table_name: {str} table name, 'fantasy' or 'draftkings'
+        '''
+        keys = TABLE_KEYS[table_name]
+
+        columns = ', '.join(map(_quote, df.columns))
+        updates = ', '.join('{0} = EXCLUDED.{0}'.format(_quote(column))
+                            for column in df.columns if column not in keys)
+
+        # COPY reads an unquoted empty field as NULL
+        data = io.StringIO()
+        df.to_csv(data, index=False, header=False)
+        data.seek(0)
+
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+
+            # Create the table from the DataFrame the first time it is loaded
+            cursor.execute("SELECT to_regclass(%s);", (_quote(table_name),))
+            if cursor.fetchone()[0] is None:
+                cursor.execute(pd.io.sql.get_schema(df, table_name,
+                                                    con=self.engine))
+
+            _ensure_indexes(cursor, table_name)
+
+            cursor.execute('''
+            CREATE TEMP TABLE staging (LIKE {} INCLUDING DEFAULTS)
+            ON COMMIT DROP;
+            '''.format(_quote(table_name)))
+            cursor.copy_expert("COPY staging ({}) FROM STDIN WITH "
+                               "(FORMAT csv);".format(columns), data)
+
+            # The players whose totals the load changes, including the ones
+            # a reloaded week moves to another position
+            if table_name in TOTALS:
+                cursor.execute('''
+                CREATE TEMP TABLE affected ON COMMIT DROP AS
+                SELECT year, position, id FROM staging
+                UNION
+                SELECT t.year, t.position, t.id
+                FROM {} t JOIN staging s USING ({});
+                '''.format(_quote(table_name),
+                           ', '.join(map(_quote, keys))))
+
+            # A page can list a player twice, and ON CONFLICT may only touch
+            # each row once
+            cursor.execute('''
+            INSERT INTO {table} ({columns})
+            SELECT DISTINCT ON ({keys}) {columns} FROM staging
+            ON CONFLICT ({keys}) DO UPDATE SET {updates};
+            '''.format(table=_quote(table_name), columns=columns,
+                       keys=', '.join(map(_quote, keys)), updates=updates))
+
+            if table_name in TOTALS:
+                _update_totals(cursor, table_name)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def ensure_totals(self, table_name='fantasy'):
+        '''
+        This method builds the running totals of a table from its weekly rows
+        when they are missing, e.g. in a database loaded before the totals
+        were kept, so query_avg works without reloading every week
+
+        PARAMETERS
+        ----------
+        table_name: {str} the table of weekly stats
+        '''
+        if table_name in self._totals_ready:
+            return
+
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT to_regclass(%s), to_regclass(%s);",
+                           (_quote(table_name), _quote(TOTALS[table_name])))
+            table, totals = cursor.fetchone()
+
+            # _update_totals builds them from the whole table the first time
+            if table is not None and totals is None:
+                _update_totals(cursor, table_name)
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        self._totals_ready.add(table_name)
+
+    def query(self, q):
+        '''
+        This method runs a query
+
+        PARAMETERS
+        ----------
+        q: {str} the SQL query
+
+        RETURNS
+        -------
+        df: {pandas.DataFrame} the result
+        '''
+        return pd.read_sql(q, self.engine)
+
+def _write_parquet(df, path):
+    '''
+    This function writes a DataFrame to a Parquet file through a temporary
+    file, so a reader never sees half of it
+
+    PARAMETERS
+    ----------
+    df: {pandas.DataFrame} the rows
+
+    path: {str} where to write them
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+class ParquetBackend:
+
+    def __init__(self, directory=DATA_DIR):
+        '''
+        The ParquetBackend object keeps each table as Parquet files partitioned
+        by year, week and position, and queries them with DuckDB, so no
+        database server is needed. Queries only read the columns and
+        partitions they use. The season totals are partitioned by year and
+        position.
+
+        PARAMETERS
+        ----------
+        directory: {str} where to keep the files, defaults to the CLUTCH_DATA
+                   environment variable or ~/.local/share/clutch
+        '''
+        self.directory = directory
+        self._totals_ready = set()
+
+    @property
+    def cache_key(self):
+        '''
+        The backend and the directory it reads, which the query cache keys
+        its results by
+        '''
+        return 'parquet:{}'.format(os.path.abspath(self.directory))
+
+    def _partition_path(self, table_name, values):
+        parts = ['{}={}'.format(column, value) for column, value in
+                 zip(PARTITIONS[table_name], values)]
+
+        return os.path.join(self.directory, table_name, *parts,
+                            'data.parquet')
+
+    def _remove_moved(self, df, table_name):
+        '''
+        This method deletes the rows a load moves to another partition, e.g.
+        a player whose position changed in a reloaded week, from the
+        partitions they were in before
+
+        PARAMETERS
+        ----------
+        df: {pandas.DataFrame} the rows
+
+        table_name: {str} table name
+
+        RETURNS
+        -------
+        touched: {list} a dict of the partition values of each partition
+                 rows were deleted from
+        '''
+        keys = TABLE_KEYS[table_name]
+        partitions = PARTITIONS[table_name]
+        # The partitions a row can move between share the key columns
+        scope = [column for column in partitions if column in keys]
+        row_keys = [key for key in keys if key not in partitions]
+
+        # The other partition columns, e.g. the position, can change
+        movable = [column for column in partitions if column not in scope]
+
+        touched = []
+        for values, rows in df.groupby(scope, sort=False):
+            values = values if isinstance(values, tuple) else (values,)
+            parts = dict(zip(scope, values))
+            pattern = self._partition_path(table_name,
+                                           [parts.get(column, '*')
+                                            for column in partitions])
+            loaded = pd.MultiIndex.from_frame(rows[row_keys])
+            # Each loaded key with the partition it is loaded into
+            staying = pd.MultiIndex.from_frame(
+                          rows[row_keys].assign(**{column:
+                              rows[column].astype(str)
+                              for column in movable}))
+
+            for path in glob(pattern):
+                path_values = dict(part.split('=', 1) for part in
+                                   os.path.relpath(os.path.dirname(path),
+                                       os.path.join(self.directory,
+                                                    table_name)).split(os.sep))
+                existing = pd.read_parquet(path)
+
+                # A row moved when its key is loaded, but into another
+                # partition than this one. Rows loaded into this partition are
+                # merged by write.
+                here = existing[row_keys].assign(**{column: path_values[column]
+                                                    for column in movable})
+                moved = pd.MultiIndex.from_frame(existing[row_keys]).\
+                            isin(loaded) & \
+                        ~pd.MultiIndex.from_frame(here).isin(staying)
+                if not moved.any():
+                    continue
+
+                if moved.all():
+                    os.remove(path)
+                else:
+                    _write_parquet(existing[~moved], path)
+                touched.append(path_values)
+
+        return touched
+
+    def write(self, df, table_name):
+        '''
+        This method upserts rows into a table. Rows the load moves to another
+        partition are deleted from their old one, and each partition the rows
+        fall in is merged with the rows already in it and rewritten.
+
+        PARAMETERS
+        ----------
+        df: {pandas.DataFrame} the rows
+
+        table_name: {str} table name, 'fantasy' or 'draftkings'
+        '''
+        keys = TABLE_KEYS[table_name]
+        partitions = PARTITIONS[table_name]
+
+        touched = self._remove_moved(df, table_name)
+
+        for values, rows in df.groupby(partitions, sort=False):
+            path = self._partition_path(table_name, values)
+            # The partition columns are read back from the path
+            rows = rows.drop(columns=partitions)
+
+            if os.path.exists(path):
+                existing = pd.read_parquet(path)
+                rows = pd.concat([existing, rows], ignore_index=True, sort=False)
+
+            rows = rows.drop_duplicates([key for key in keys
+                                         if key not in partitions],
+                                        keep='last')
+            _write_parquet(rows, path)
+
+        if table_name in TOTALS:
+            # Including the positions players moved away from
+            seasons = set((str(year), str(position)) for year, position in
+                          df.groupby(['year', 'position']).groups)
+            seasons.update((values['year'], values['position'])
+                           for values in touched)
+            for year, position in seasons:
+                self._update_totals(table_name, year, position)
+
+    def _update_totals(self, table_name, year, position):
+        '''
+        This method recomputes the running totals of one position in one
+        season from its weekly partitions
+
+        PARAMETERS
+        ----------
+        table_name: {str} the table of weekly stats
+
+        year: {int} the NFL season year
+
+        position: {str} the position
+        '''
+        pattern = os.path.join(self.directory, table_name,
+                               'year={}'.format(year), 'week=*',
+                               'position={}'.format(position), 'data.parquet')
+        paths = glob(pattern)
+        totals_path = self._partition_path(TOTALS[table_name],
+                                           (year, position))
+
+        # Every player moved away from the position
+        if len(paths) == 0:
+            if os.path.exists(totals_path):
+                os.remove(totals_path)
+            return
+
+        weeks = pd.concat([pd.read_parquet(path) for path in paths],
+                          ignore_index=True, sort=False)
+
+        sums = {column: (column, 'sum') for column in TOTAL_COLUMNS
+                if column in weeks.columns}
+        totals = weeks.groupby('id').agg(name=('name', 'max'),
+                                         weeks=('name', 'size'), **sums)
+
+        _write_parquet(totals.reset_index(), totals_path)
+
+    def ensure_totals(self, table_name='fantasy'):
+        '''
+        This method builds the running totals of a table from its weekly
+        partitions when they are missing, e.g. for files written before the
+        totals were kept, so query_avg works without reloading every week
+
+        PARAMETERS
+        ----------
+        table_name: {str} the table of weekly stats
+        '''
+        if table_name in self._totals_ready:
+            return
+
+        if not os.path.isdir(os.path.join(self.directory,
+                                          TOTALS[table_name])):
+            pattern = os.path.join(self.directory, table_name, 'year=*',
+                                   'week=*', 'position=*')
+            seasons = set()
+            for path in glob(pattern):
+                path, position = os.path.split(path)
+                year = os.path.basename(os.path.dirname(path))
+                seasons.add((year.split('=', 1)[1],
+                             position.split('=', 1)[1]))
+
+            for year, position in seasons:
+                self._update_totals(table_name, year, position)
+
+        self._totals_ready.add(table_name)
+
+    def query(self, q):
+        '''
+        This method runs a query, with each table available as a view over
+        its Parquet files
+
+        PARAMETERS
+        ----------
+        q: {str} the SQL query
+
+        RETURNS
+        -------
+        df: {pandas.DataFrame} the result
+        '''
+        import duckdb
+
+        conn = duckdb.connect()
+        try:
+            for table_name in PARTITIONS:
+                table_dir = os.path.join(self.directory, table_name)
+                if not os.path.isdir(table_dir):
+                    continue
+
+                pattern = os.path.join(table_dir, '**', '*.parquet')
+                conn.execute('''
+                CREATE VIEW {} AS
+                SELECT * FROM read_parquet('{}', hive_partitioning=true,
+                                           union_by_name=true);
+                '''.format(_quote(table_name), pattern.replace("'", "''")))
+
+            return conn.execute(q).df()
+        finally:
+            conn.close()
+
+BACKENDS = {'postgres': PostgresBackend, 'parquet': ParquetBackend}
+
+def get_backend():
+    '''
+    This function returns the storage backend the pipeline reads and writes,
+    creating the one named by CLUTCH_STORAGE on first use
+
+    RETURNS
+    -------
+    backend: {PostgresBackend or ParquetBackend}
+    '''
+    global _backend
+
+    if _backend is None:
+        _backend = BACKENDS[STORAGE]()
+
+    return _backend
+
+def set_backend(backend):
+    '''
+    This function replaces the storage backend, e.g. with a ParquetBackend
+    for local analysis
+
+    PARAMETERS
+    ----------
+    backend: {PostgresBackend or ParquetBackend}
+    '''
+    global _backend
+
+    _backend = backend
+
+def check_reload():
+    '''
+    This function checks, in a temporary ParquetBackend, that reloading a
+    week in which players changed position leaves one row per player in the
+    week and in the season totals
+
+    RAISES
+    ------
+    AssertionError: when a player is counted twice
+    '''
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    try:
+        backend = ParquetBackend(directory)
+        week = pd.DataFrame({'id': [1, 2, 3, 4],
+                             'name': ['A', 'B', 'C', 'D'],
+                             'year': 2017, 'week': 1,
+                             'position': ['QB', 'RB', 'WR', 'TE'],
+                             'weekpts': [10., 20., 30., 40.]})
+        backend.write(week, 'fantasy')
+
+        # Every partition of the week gets rows again, and three players
+        # move into each other's positions
+        reloaded = week.assign(position=['RB', 'WR', 'QB', 'TE'],
+                               weekpts=[11., 21., 31., 41.])
+        backend.write(reloaded, 'fantasy')
+
+        rows = backend.query('SELECT id, position, weekpts FROM fantasy '
+                             'ORDER BY id;')
+        assert rows['id'].tolist() == [1, 2, 3, 4], rows
+        assert rows['position'].tolist() == ['RB', 'WR', 'QB', 'TE'], rows
+        assert rows['weekpts'].tolist() == [11., 21., 31., 41.], rows
+
+        totals = backend.query('SELECT id, position, weeks, weekpts '
+                               'FROM fantasy_totals ORDER BY id;')
+        assert totals['id'].tolist() == [1, 2, 3, 4], totals
+        assert totals['position'].tolist() == ['RB', 'WR', 'QB', 'TE'], totals
+        assert totals['weeks'].tolist() == [1, 1, 1, 1], totals
+        assert totals['weekpts'].tolist() == [11., 21., 31., 41.], totals
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    check_reload()
+    print("Reloading a week with position changes counts every player once.")
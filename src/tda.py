@@ -3,16 +3,262 @@ import sys
 module_path = os.path.abspath(os.path.join('..'))
 if module_path not in sys.path:
     sys.path.append(module_path)
-import pandas as pd
+import hashlib
+import tempfile
+from collections import OrderedDict, namedtuple
 import numpy as np
-import dionysus as d
-from itertools import product, combinations
 from scipy.spatial.distance import cdist
-import plotly.plotly as py
-import plotly.graph_objs as go
-import plotly.figure_factory as FF
-import igraph as ig
-import pymongo
+from src.simplicial import SimplicialComplex, Filtration
+from src import metrics
+from src.documents import encode_value, decode_value, to_gridfs, \
+                          from_gridfs, gridfs_files, delete_gridfs
+
+def _extend_combinations(combos, n):
+    '''
+    This function extends every combination of range(n) by each index greater 
+    than its last one without leaving NumPy. Extending the lexicographically
+    ordered r-combinations gives the (r+1)-combinations in lexicographic order,
+    so repeated extension matches itertools.combinations.
+
+    PARAMETERS
+    ----------
+    combos: {array} a (m, r) array of combinations in lexicographic order
+
+    n: {int} the number of items to choose from
+
+    RETURNS
+    -------
+    combos: {array} a (m', r+1) array of combinations in lexicographic order
+    '''
+    last = combos[:, -1]
+    counts = n - 1 - last
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.repeat(last + 1, counts)
+    following = np.arange(counts.sum(), dtype=np.int64) - offsets + starts
+
+    return np.column_stack([np.repeat(combos, counts, axis=0), following])
+
+def _unique_simplices(simplices, n):
+    '''
+    This function deduplicates simplices by packing each one into a single 
+    integer key, which also sorts them lexicographically
+
+    PARAMETERS
+    ----------
+    simplices: {array} a (m, r) array of sorted vertex indices
+
+    n: {int} the number of vertices, used as the base of the packed keys
+
+    RETURNS
+    -------
+    simplices: {array} the unique simplices in lexicographic order
+    '''
+    r = simplices.shape[1]
+
+    # The keys of high dimensional simplices on many vertices do not fit in 
+    # 64 bits, so fall back to comparing whole rows
+    if n ** r > np.iinfo(np.int64).max:
+        return np.unique(simplices, axis=0)
+
+    keys = np.zeros(simplices.shape[0], dtype=np.int64)
+    for column in range(r):
+        keys = keys * n + simplices[:, column]
+    keys = np.unique(keys)
+
+    unique = np.empty((keys.shape[0], r), dtype=np.int64)
+    for column in reversed(range(r)):
+        keys, unique[:, column] = np.divmod(keys, n)
+
+    return unique
+
+def _maximal_witnesses(visible):
+    '''
+    This function removes the witnesses whose visible vertices are all visible
+    to some other witness, since every simplex they witness is witnessed by 
+    that other witness as well
+
+    PARAMETERS
+    ----------
+    visible: {array} boolean (witnesses, vertices) array of visibility
+
+    RETURNS
+    -------
+    rows: {array} the distinct visibility rows of the maximal witnesses
+    '''
+    rows = np.unique(visible, axis=0)
+    rows = rows[rows.any(axis=1)]
+    counts = rows.sum(axis=1)
+
+    # Row i is contained in row j when they share all of row i's vertices, 
+    # and since the rows are distinct row j then sees strictly more vertices
+    shared = np.dot(rows.astype(np.int64), rows.T.astype(np.int64))
+    contained = (shared == counts.reshape(-1, 1)) & \
+                (counts.reshape(1, -1) > counts.reshape(-1, 1))
+
+    return rows[~contained.any(axis=1)]
+
+def _witness_skeleton(visible, k=2):
+    '''
+    This function builds the simplices up to dimension k of a witness complex.
+    Rather than testing every combination of vertices against every witness,
+    each (r+1)-simplex candidate is only generated by extending an r-simplex 
+    with another vertex visible to a witness of that r-simplex, so the search 
+    is pruned to cliques of commonly witnessed vertices and the cost grows with 
+    the size of the complex.
+
+    PARAMETERS
+    ----------
+    visible: {array} boolean (witnesses, vertices) array of visibility
+
+    k: {int} the highest dimension of the simplices
+
+    RETURNS
+    -------
+    skeleton: {list} for each dimension up to k, a (m, dimension+1) array of
+              simplices in lexicographic order
+    '''
+    rows = _maximal_witnesses(visible)
+    counts = rows.sum(axis=1)
+
+    # Witnesses that see the same number of vertices share one combination
+    # table, so each group is expanded with a single fancy index
+    groups = []
+    for count in np.unique(counts):
+        seen = np.nonzero(rows[counts == count])[1].reshape(-1, count)
+        groups.append((seen, np.arange(count, dtype=np.int64).reshape(-1, 1)))
+
+    skeleton = []
+    for r in range(1, k+2):
+        blocks = []
+        for i, (seen, combos) in enumerate(groups):
+            if r > 1:
+                combos = _extend_combinations(combos, seen.shape[1])
+                groups[i] = (seen, combos)
+            if combos.shape[0] > 0:
+                blocks.append(seen[:, combos].reshape(-1, r))
+
+        if len(blocks) == 0:
+            skeleton.append(np.empty((0, r), dtype=np.int64))
+        elif rows.shape[0] == 1:
+            # A single witness generates each simplex once and in order
+            skeleton.append(blocks[0])
+        else:
+            skeleton.append(_unique_simplices(np.concatenate(blocks), 
+                                              visible.shape[1]))
+
+    return skeleton
+
+def _witness_births(distances, simplices, chunk_size=2**22):
+    '''
+    This function computes the exact visibility threshold at which each simplex
+    of a witness complex is born: the smallest, over all witnesses, of the 
+    largest distance from that witness to the vertices of the simplex
+
+    PARAMETERS
+    ----------
+    distances: {array} (witnesses, vertices) array of distances
+
+    simplices: {array} a (m, r) array of simplices
+
+    chunk_size: {int} the number of distances to hold in memory at once
+
+    RETURNS
+    -------
+    births: {array} the birth of each simplex
+    '''
+    births = np.empty(simplices.shape[0])
+    step = max(1, chunk_size // (distances.shape[0] * max(1, simplices.shape[1])))
+
+    for start in range(0, simplices.shape[0], step):
+        block = simplices[start:start+step]
+        births[start:start+step] = distances[:, block].max(axis=2).min(axis=0)
+
+    return births
+
+def _witness_filtration(distances, k=2, end=None):
+    '''
+    This function builds the filtration of a witness complex with the exact 
+    birth of every simplex, each simplex appearing once
+
+    PARAMETERS
+    ----------
+    distances: {array} (witnesses, vertices) array of distances
+
+    k: {int} the highest dimension of the simplices
+
+    end: {float} the largest visibility threshold, defaults to the largest
+         distance so that the filtration ends with the full complex
+
+    RETURNS
+    -------
+    filtration: {Filtration} the simplices sorted by birth
+    '''
+    if end is None:
+        end = distances.max()
+
+    skeleton = _witness_skeleton(distances <= end, k)
+    births = [_witness_births(distances, simplices) for simplices in skeleton]
+
+    return Filtration(skeleton, births)
+
+def _zero_persistence(distances):
+    '''
+    This function computes the 0-dimensional persistence diagram of a witness 
+    complex directly from the witness-vertex distances. Two vertices are joined
+    at the first threshold where a path of witnesses and vertices connects 
+    them, so sorting the distances once and running a union-find over the 
+    witnesses and vertices gives every merge of the filtration's components 
+    without building any simplices.
+
+    PARAMETERS
+    ----------
+    distances: {array} (witnesses, vertices) array of distances
+
+    RETURNS
+    -------
+    diagram: {array} a (m, 2) array of the birth and death of each component,
+             sorted by birth, with a death of inf for the components that 
+             never die
+    '''
+    n_witnesses, n_vertices = distances.shape
+
+    # The vertices are the first n_vertices nodes and the witnesses the rest.
+    # A vertex is born at the distance to its nearest witness, and a witness
+    # does not start a component of its own
+    parent = list(range(n_vertices + n_witnesses))
+    birth = distances.min(axis=0).tolist() + [np.inf] * n_witnesses
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    order = np.argsort(distances, axis=None, kind='mergesort')
+    witnesses, vertices = np.unravel_index(order, distances.shape)
+
+    diagram = []
+    for w, v, p in zip((witnesses + n_vertices).tolist(), vertices.tolist(),
+                       distances.ravel()[order].tolist()):
+        root_v = find(v)
+        root_w = find(w)
+        if root_v == root_w:
+            continue
+
+        # By the elder rule the younger component dies when two merge
+        if birth[root_v] < birth[root_w]:
+            root_v, root_w = root_w, root_v
+        if birth[root_v] < np.inf and p > birth[root_v]:
+            diagram.append((birth[root_v], p))
+        parent[root_v] = root_w
+
+    diagram += [(birth[v], np.inf) for v in range(n_vertices) if find(v) == v]
+    diagram = np.array(diagram, dtype=float).reshape(-1, 2)
+
+    return diagram[np.lexsort((diagram[:, 1], diagram[:, 0]))]
 
 class ClutchMapper:
 
@@ -68,7 +314,7 @@ class ClutchMapper:
 
         return self
 
-    def build_complex(self, p, k = 3):
+    def build_complex(self, p, k = 2):
         '''
         This function constructs the simplices for a simplicial complex given a 
         cover, data, and a threshold of overlapping points
@@ -77,192 +323,484 @@ class ClutchMapper:
         ----------
         p: {float} the visibility threshold to form simplices
 
-        # TODO: Implement this
-        k: {int} specifify up to which dimension k-complex to calculate
+        k: {int} specifify up to which dimension k-complex to calculate, e.g.
+           k=3 adds tetrahedra
 
         RETURNS
         -------
-        landmark_complex: {list} a list of lists containing the simplices
-        observer_complex: {list} a list of lists containing the simplices
+        observer_complex: {SimplicialComplex} the simplices, which iterate as 
+                          lists
+        landmark_complex: {SimplicialComplex} the simplices, which iterate as
+                          lists
         '''
-        # Subtract the distances computed in the fit method from p to see which
+        # Compare the distances computed in the fit method to p to see which
         # observations and landmarks are visible to each other
-        within_p = np.sign(p - self.distances_)
-        # If within_p[o,l] is -1, l is more than p from o
-        # If within_p[o,l] is 1, l is within p of o
+        within_p = self.distances_ < p
+        # If within_p[o,l] is False, l is more than p from o
+        # If within_p[o,l] is True, l is within p of o
 
         # Observation Complex
         # ----------------
         # Observation are the centroids of the cover we build 
         # k-simplices are collections of (k+1) distinct observations that have
-        # some landmark in common
-        observer_complex = [] # instantiate complex as an empty list
-
-
-        # 0-simplices (vertices) are added when an observation is visible
-        # to a landmark
-        for i in self.O_:
-            for l in self.L_:
-                if within_p[i,l]== 1:
-                    observer_complex.append([i])
-                    break
-
-        # 1-simplices (edges) are added when an two observations are visible to
-        # a landmark
-        for i,j in combinations(self.O_, 2):
-            for l in self.L_:
-                if within_p[i,l]+within_p[j,l] == 2:
-                    observer_complex.append([i,j])
-                    break
-
-        # 2-simplices (faces) are added when three observations are visible to 
-        # a landmark
-        for i,j,k in combinations(self.O_,3):
-            for l in self.L_:
-                if within_p[i,l]+within_p[j,l]+within_p[k,l] == 3:
-                    observer_complex.append([i,j,k])
-                    break
-
-        # # 3-simplices (tetrahedra) are added when four observations are 
-        # # visible to a landmark
-        # for i,j,k,h in combinations(self.O_,4):
-        #     for l in self.L_:
-        #         if within_p[i,l]+within_p[j,l]+within_p[k,l]+within_p[h,l] == 4:
-        #             observer_complex.append([i,j,k,h])
-        #             break
+        # some landmark in common, so the landmarks are the witnesses
+
+        # 0-simplices (vertices) are added when an observation is visible to a
+        # landmark, 1-simplices (edges) when two observations are, 2-simplices
+        # (faces) when three are, and so on up to k-simplices
+        observer_complex = SimplicialComplex(_witness_skeleton(within_p.T, k))
 
         # Landmark Complex
         # ----------------
         # Landmarks are the data points of each player 
         # k-simplexes are collections of (k+1) distinct landmarks that have some
-        # observation in common
-        landmark_complex = [] # instantiate complex as a list
-
-        # 0-simplices (vertices) are added when a landmark is visible to an 
-        # observation
-        for i in self.L_:
-            for o in self.O_:
-                if within_p[o,i] == 1:
-                    landmark_complex.append([i])
-                    break
-
-
-        # 1-simplices (edges) are added when two landmarks are visible to an
-        # observation
-        for i,j in combinations(self.L_, 2):
-            for o in self.O_:
-                if within_p[o,i]+within_p[o,j] == 2:
-                    landmark_complex.append([i,j])
-                    break
-
-        # 2-simplices (faces) are added when three landmarks are visible to an
-        # observation
-        for i,j,k in combinations(self.L_,3):
-            for o in self.O_:
-                if within_p[o,i]+within_p[o,j]+within_p[o,k] == 3:
-                    landmark_complex.append([i,j,k])
-                    break
-
-        # # 3-simplices (tetrahedra) are added when four landmarks are visible 
-        # # to an observation
-        # for i,j,k,h in combinations(self.L_4):
-        #     for o in self.O_:
-        #         if within_p[o,i]+within_p[o,j]+within_p[o,k]+within_p[o,h] == 4:
-        #             landmark_complex.append([i,j,k,h])
-        #             break
+        # observation in common, so the observations are the witnesses
+
+        # 0-simplices (vertices) are added when a landmark is visible to an
+        # observation, 1-simplices (edges) when two landmarks are, 2-simplices
+        # (faces) when three are, and so on up to k-simplices
+        landmark_complex = SimplicialComplex(_witness_skeleton(within_p, k))
 
         return observer_complex, landmark_complex
 
-    def build_filtrations(self):
+    def build_filtrations(self, end=None, k=2):
         '''
-        This method constructs a filtration given a cover and the data
+        This method constructs a filtration given a cover and the data. Each 
+        simplex is added once, with the exact visibility threshold it is born 
+        at, computed directly from the distances.
+
+        PARAMETERS
+        ----------
+        end: {float} the largest visibility threshold, defaults to the maximum
+             visibility
+
+        k: {int} specifify up to which dimension k-complex to calculate
         
         RETURNS
         -------
-        filtration {dionysus.Filtration} a filtration of simplicial complices
+        observer_filtration: {Filtration} the filtration of the observation 
+                             complex, see Filtration.to_dionysus
+        landmark_filtration: {Filtration} the filtration of the landmark 
+                             complex, see Filtration.to_dionysus
         '''
-        # Instantiate the filtration objects
-        self.observer_filtration_ = d.Filtration()
-        self.landmark_filtration_ = d.Filtration()
+        # For the observation complex the landmarks are the witnesses, and for
+        # the landmark complex the observations are the witnesses
+        if end is None:
+            end = self.distances_.max()
 
-        # Set the end of the filtration to be the maximum visibility
-        end = self.distances_.max()
-        
-        # Build iterative complexes and add simplices to filtration with the 
-        # visibility threshold they were born
-        for p in np.linspace(0,end):
-            observer_complex, landmark_complex = self.build_complex(p)
-            
-            for simplex in observer_complex:
-                self.observer_filtration_.append(d.Simplex(simplex, p))
+        self.observer_filtration_ = _witness_filtration(self.distances_.T, k, end)
+        self.landmark_filtration_ = _witness_filtration(self.distances_, k, end)
+        self.filtration_params_ = (k, end)
+
+        return self.observer_filtration_, self.landmark_filtration_
 
-            for simplex in landmark_complex:
-                self.landmark_filtration_.append(d.Simplex(simplex, p))
+    def to_arrays(self):
+        '''
+        This method collects the fitted cover, distances and filtrations into
+        a dictionary of arrays, e.g. to save them with numpy.savez
 
-        # Sort the filtrations
-        self.observer_filtration_.sort()
-        self.landmark_filtration_.sort()
+        RETURNS
+        -------
+        arrays: {dict} the fitted state as arrays
+        '''
+        arrays = {'unique_labels': np.array(self.unique_labels_),
+                  'centroids': self.observers_,
+                  'radii': np.array([self.cover_[i][1] for i in self.cover_]),
+                  'distances': self.distances_}
+
+        if hasattr(self, 'filtration_params_'):
+            arrays['filtration_params'] = np.array(self.filtration_params_)
+            for name, filtration in [('observer', self.observer_filtration_),
+                                     ('landmark', self.landmark_filtration_)]:
+                for dim in range(filtration.k + 1):
+                    arrays['{}_simplices_{}'.format(name, dim)] = \
+                        filtration.simplices[dim]
+                    arrays['{}_births_{}'.format(name, dim)] = \
+                        filtration.births[dim]
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, data, labels, arrays, metric='euclidean'):
+        '''
+        This method builds a fitted ClutchMapper from the arrays returned by
+        to_arrays without refitting
 
+        PARAMETERS
+        ----------
+        data: {array} point cloud data that become the landmarks
 
-        return self.observer_filtration_, self.landmark_filtration_
+        labels: {array} labels from clustering the data in a reduced 
+                dimensionality that become the observers
+
+        arrays: {dict} the fitted state as arrays
+
+        metric: {str} the distance metric
+
+        RETURNS
+        -------
+        cmapper: {ClutchMapper}
+        '''
+        cmapper = cls(metric)
+        cmapper.landmarks_ = data
+        cmapper.labels = labels
+        cmapper.unique_labels_ = arrays['unique_labels'].tolist()
+        cmapper.cover_ = {label: (centroid.reshape(1,-1), radius)
+                          for label, centroid, radius in 
+                          zip(cmapper.unique_labels_, arrays['centroids'],
+                              arrays['radii'].tolist())}
+        cmapper.observers_ = arrays['centroids']
+        cmapper.O_ = range(len(cmapper.observers_))
+        cmapper.L_= range(len(cmapper.landmarks_))
+        cmapper.distances_ = arrays['distances']
+
+        if 'filtration_params' in arrays:
+            k, end = arrays['filtration_params'].tolist()
+            cmapper.filtration_params_ = (int(k), end)
+            filtrations = []
+            for name in ['observer', 'landmark']:
+                simplices = [arrays['{}_simplices_{}'.format(name, dim)]
+                             for dim in range(int(k) + 1)]
+                births = [arrays['{}_births_{}'.format(name, dim)]
+                          for dim in range(int(k) + 1)]
+                filtrations.append(Filtration(simplices, births))
+            cmapper.observer_filtration_, cmapper.landmark_filtration_ = \
+                filtrations
+
+        return cmapper
+
+    def zero_persistence(self):
+        '''
+        This method computes the persistence diagrams of the 0-dimensional 
+        homology, beta_0, of the observation and landmark filtrations without
+        building the filtrations
 
-def visualize_complex(simplicial_complex, title=None, names=None):
+        RETURNS
+        -------
+        observer_diagram: {array} a (m, 2) array of the birth and death of each
+                          component of the observation complex
+        landmark_diagram: {array} a (m, 2) array of the birth and death of each
+                          component of the landmark complex
+        '''
+        # For the observation complex the landmarks are the witnesses, and for
+        # the landmark complex the observations are the witnesses
+        observer_diagram = _zero_persistence(self.distances_.T)
+        landmark_diagram = _zero_persistence(self.distances_)
+
+        return observer_diagram, landmark_diagram
+
+    def iter_complexes(self, thresholds, k=2, delta=False):
+        '''
+        This method sweeps the observation and landmark complexes across 
+        several visibility thresholds in a single pass. The birth of every 
+        simplex is computed once, and each complex is then a prefix of the 
+        filtration instead of a rebuild from scratch.
+
+        PARAMETERS
+        ----------
+        thresholds: {array} the visibility thresholds, swept in increasing 
+                    order
+
+        k: {int} specifify up to which dimension k-complex to calculate
+
+        delta: {bool} whether to only yield the simplices added since the 
+               previous threshold
+
+        YIELDS
+        ------
+        p: {float} the visibility threshold
+
+        observer_complex: {SimplicialComplex} the observation complex at p
+
+        landmark_complex: {SimplicialComplex} the landmark complex at p
+
+        The simplices of each dimension are in lexicographic order, like
+        build_complex returns them, so the figures of the same complex match.
+
+        Once every simplex has been born the complexes are saturated and stop
+        changing. After that the same complexes are yielded
+        for the remaining thresholds without any work, and when delta is True
+        the sweep stops instead since nothing else will be added.
+        '''
+        thresholds = np.sort(np.asarray(thresholds, dtype=float))
+        if thresholds.shape[0] == 0:
+            return
+
+        # The filtrations only need to reach the last threshold, and when they
+        # reach the maximum visibility they hold every simplex
+        end = min(thresholds[-1], self.distances_.max())
+        complete = end == self.distances_.max()
+
+        # Reuse the filtrations from build_filtrations if they reach far enough
+        if hasattr(self, 'filtration_params_') and \
+                self.filtration_params_[0] == k and \
+                self.filtration_params_[1] >= end:
+            observer_filtration = self.observer_filtration_
+            landmark_filtration = self.landmark_filtration_
+        else:
+            observer_filtration = _witness_filtration(self.distances_.T, k, end)
+            landmark_filtration = _witness_filtration(self.distances_, k, end)
+        last_birth = max(observer_filtration.end, landmark_filtration.end)
+
+        saturated = False
+        previous = -np.inf
+        for p in thresholds.tolist():
+            if saturated and delta:
+                return
+
+            if not saturated:
+                start = previous if delta else -np.inf
+                with metrics.stage('build_complex', threshold=p) as m:
+                    observer_complex = observer_filtration.\
+                                           born_between(start, p).sorted()
+                    landmark_complex = landmark_filtration.\
+                                           born_between(start, p).sorted()
+                    m['n_simplices'] = len(observer_complex) + \
+                                       len(landmark_complex)
+                saturated = complete and p > last_birth
+                previous = p
+
+            yield p, observer_complex, landmark_complex
+
+# A layout is the 3D coordinates of the vertices of a complex, row by row
+Layout = namedtuple('Layout', ['vertices', 'coords'])
+
+def _layout_rows(layout, vertices):
     '''
-    This function constructs a visualization of the given simplical complex
+    This function finds the row of each vertex in a layout
 
     PARAMETERS
     ----------
-    simplicial_complex: {list} a list containing simplices of the complex
+    layout: {Layout} the layout
 
-    title: {str} title of the plot
+    vertices: {array} the vertices to find
+
+    RETURNS
+    -------
+    rows: {array} the row of each vertex, or -1 when the layout does not have
+          the vertex
+    '''
+    size = max(layout.vertices.max() if len(layout.vertices) > 0 else -1,
+               vertices.max() if len(vertices) > 0 else -1) + 1
+    index = np.full(size, -1)
+    index[layout.vertices] = np.arange(len(layout.vertices))
+
+    return index[vertices]
+
+def compute_layout(simplicial_complex):
+    '''
+    This function lays out the 1-skeleton of a complex in 3D with igraph's
+    Kamada-Kawai layout
 
-    filename: {str} filename of the output plot
+    PARAMETERS
+    ----------
+    simplicial_complex: {SimplicialComplex} or {list} the complex
 
     RETURNS
     -------
-    fig: {plotly.graph_objs.Figure}
+    layout: {Layout}
     '''
-    vertices = [simplex for simplex_list in simplicial_complex for simplex in simplex_list if len(simplex_list) == 1]
-    simplex_dict = {v:i for i,v in enumerate(vertices)}
-    edges = [simplex for simplex in simplicial_complex if len(simplex) == 2]
-    edge_list = [[simplex_dict[edge[0]], simplex_dict[edge[1]]] for edge in edges]
-    faces = [simplex for simplex in simplicial_complex if len(simplex) == 3]
-    face_list = [[simplex_dict[face[0]], simplex_dict[face[1]], simplex_dict[face[2]]] for face in faces]
-    # tetrahedra = [simplex for simplex in simplicial_complex if len(simplex) == 4]
+    import igraph as ig
+
+    simplicial_complex = SimplicialComplex.from_list(simplicial_complex)
+    vertex_array = simplicial_complex.vertices
+
+    # Map each vertex to its index in the graph
+    simplex_index = np.zeros(vertex_array.max()+1 if len(vertex_array) > 0
+                             else 0, dtype=int)
+    simplex_index[vertex_array] = np.arange(len(vertex_array))
+    edge_list = simplex_index[simplicial_complex.dimension(1)].tolist()
 
     g = ig.Graph()
-    g.add_vertices(vertices)
+    g.add_vertices(vertex_array.tolist())
     g.add_edges(edge_list)
-    layt = g.layout('kk_3d')
 
-    x_vertex=[layt[k][0] for k in range(len(vertices))]
-    y_vertex=[layt[k][1] for k in range(len(vertices))]
-    z_vertex=[layt[k][2] for k in range(len(vertices))]
+    with metrics.stage('layout', n_vertices=len(vertex_array),
+                       n_edges=len(edge_list)):
+        layt = g.layout('kk_3d')
+
+    return Layout(vertex_array.copy(), np.array(layt.coords).reshape(-1, 3))
+
+class LayoutCache:
+
+    def __init__(self, directory=None, max_layouts=128):
+        '''
+        The LayoutCache object keeps the layouts of complexes keyed by a hash
+        of their vertices and edges, so figures of the same graph are laid
+        out once and keep their coordinates.
+
+        PARAMETERS
+        ----------
+        directory: {str} where to save the layouts as .npz files, or None to
+                   only keep them in memory
+
+        max_layouts: {int} the number of layouts kept in memory
+        '''
+        self.directory = directory
+        self.max_layouts = max_layouts
+        self._layouts = OrderedDict()
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
 
-    x_edge = []
-    y_edge = []
-    z_edge = []
+    def key(self, simplicial_complex):
+        '''
+        This method hashes the vertices and edges of a complex
 
-    for edge in edge_list:
-        x_edge += [layt[edge[0]][0], layt[edge[1]][0], None]
-        y_edge += [layt[edge[0]][1], layt[edge[1]][1], None]
-        z_edge += [layt[edge[0]][2], layt[edge[1]][2], None]
+        PARAMETERS
+        ----------
+        simplicial_complex: {SimplicialComplex} the complex
 
-    if names == None:
-        names = vertices
+        RETURNS
+        -------
+        key: {str} the hex digest
+        '''
+        digest = hashlib.sha1()
+        for dim in [0, 1]:
+            simplices = simplicial_complex.dimension(dim)
+            # The hash should not depend on the order of the simplices
+            simplices = np.sort(simplices.astype(np.int64), axis=1)
+            simplices = simplices[np.lexsort(simplices.T[::-1])]
+            digest.update(simplices.tobytes())
+            digest.update(b'|')
+
+        return digest.hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.npz')
+
+    def _remember(self, key, layout):
+        self._layouts[key] = layout
+        self._layouts.move_to_end(key)
+        while len(self._layouts) > self.max_layouts:
+            self._layouts.popitem(last=False)
+
+    def layout(self, simplicial_complex):
+        '''
+        This method returns the layout of a complex, computing it when it is
+        not cached
+
+        PARAMETERS
+        ----------
+        simplicial_complex: {SimplicialComplex} or {list} the complex
+
+        RETURNS
+        -------
+        layout: {Layout}
+        '''
+        simplicial_complex = SimplicialComplex.from_list(simplicial_complex)
+        key = self.key(simplicial_complex)
+
+        layout = self._layouts.get(key)
+        if layout is None and self.directory is not None:
+            layout = self.load(key)
+        if layout is None:
+            layout = compute_layout(simplicial_complex)
+            if self.directory is not None:
+                self.save(key, layout)
+
+        self._remember(key, layout)
+
+        return layout
+
+    def save(self, name, layout):
+        '''
+        This method saves a layout under a name
+
+        PARAMETERS
+        ----------
+        name: {str} the name
+
+        layout: {Layout} the layout
+        '''
+        # Write to a temporary file first so a reader never sees half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, vertices=layout.vertices, coords=layout.coords)
+        os.replace(tmp_path, self._path(name))
+
+    def load(self, name):
+        '''
+        This method loads the layout saved under a name
+
+        PARAMETERS
+        ----------
+        name: {str} the name
+
+        RETURNS
+        -------
+        layout: {Layout} the layout, or None when there is none
+        '''
+        try:
+            with np.load(self._path(name)) as arrays:
+                return Layout(arrays['vertices'], arrays['coords'])
+        except (IOError, KeyError, ValueError):
+            return None
+
+def visualize_complex(simplicial_complex, title=None, names=None, layout=None):
+    '''
+    This function constructs a visualization of the given simplical complex
+
+    PARAMETERS
+    ----------
+    simplicial_complex: {SimplicialComplex} or {list} a list containing 
+                        simplices of the complex
+
+    title: {str} title of the plot
+
+    names: {list} the name of each vertex
+
+    layout: {Layout} the coordinates of the vertices, e.g. the layout of the
+            last complex of a filtration so every frame shares it, defaults
+            to laying out this complex
+
+    RETURNS
+    -------
+    fig: {plotly.graph_objs.Figure}
+    '''
+    import plotly.graph_objs as go
+
+    simplicial_complex = SimplicialComplex.from_list(simplicial_complex)
+    vertex_array = simplicial_complex.vertices
+
+    # Map each vertex to its index in the graph
+    simplex_index = np.zeros(vertex_array.max()+1 if len(vertex_array) > 0
+                             else 0, dtype=int)
+    simplex_index[vertex_array] = np.arange(len(vertex_array))
+    edges = simplex_index[simplicial_complex.dimension(1)]
+    faces = simplex_index[simplicial_complex.dimension(2)]
+
+    if layout is None:
+        layout = compute_layout(simplicial_complex)
+
+    rows = _layout_rows(layout, vertex_array)
+    if np.any(rows < 0):
+        raise ValueError('The layout does not have every vertex of the '
+                         'complex')
+    coords = layout.coords[rows]
+
+    # Each edge is drawn as its two endpoints followed by a NaN, which breaks
+    # the line before the next edge
+    edge_coords = np.full((len(edges), 3, 3), np.nan)
+    edge_coords[:, 0] = coords[edges[:, 0]]
+    edge_coords[:, 1] = coords[edges[:, 1]]
+    edge_coords = edge_coords.reshape(-1, 3)
+
+    if names is None:
+        names = vertex_array
     else:
-        names = list(np.array(names)[vertices])
-        
+        names = np.asarray(names)[vertex_array]
+
     data = [
         go.Scatter3d(
-            x = x_vertex,
-            y = y_vertex,
-            z = z_vertex,
+            x = coords[:, 0],
+            y = coords[:, 1],
+            z = coords[:, 2],
             mode = 'markers',
             name = 'Vertices',
             marker=dict(symbol='circle',
                                 size=6,
-                                color=vertices,
+                                color=vertex_array,
                                 colorscale='Viridis',
                                 line=dict(color='rgb(50,50,50)', width=0.5)
                                 ),
@@ -270,24 +808,24 @@ def visualize_complex(simplicial_complex, title=None, names=None):
                 hoverinfo='text'
         ),
         go.Scatter3d(
-            x = x_edge,
-            y = y_edge,
-            z = z_edge,
+            x = edge_coords[:, 0],
+            y = edge_coords[:, 1],
+            z = edge_coords[:, 2],
             mode = 'lines',
             name = 'Edges'
         ),
     ]
 
     if len(faces) > 0:
-        i, j, k = np.array(face_list).T
+        i, j, k = faces.T
         data.append(
             go.Mesh3d(
-                x = x_vertex,
-                y = y_vertex,
-                z = z_vertex,
-                i = [np.asscalar(n) for n in i],
-                j = [np.asscalar(n) for n in j],
-                k = [np.asscalar(n) for n in k],
+                x = coords[:, 0],
+                y = coords[:, 1],
+                z = coords[:, 2],
+                i = i,
+                j = j,
+                k = k,
                 opacity = 0.25,
                 name = 'Faces'
             )
@@ -302,7 +840,7 @@ def visualize_complex(simplicial_complex, title=None, names=None):
             title=''
             )
 
-    layout = go.Layout(
+    fig_layout = go.Layout(
             title=title,
             width=800,
             height=600,
@@ -316,139 +854,299 @@ def visualize_complex(simplicial_complex, title=None, names=None):
             t=100
         )
     )
-    fig = go.Figure(data=data, layout=layout)
+    fig = go.Figure(data=data, layout=fig_layout)
+
+    return fig
+
+def visualize_filtration(deltas, title=None, names=None, layout=None,
+                         thresholds=None):
+    '''
+    This function constructs a single visualization of a filtration from the
+    simplices added at each threshold. The vertices, edges and faces of the
+    figure are ordered by birth, so the complex at each threshold is a prefix
+    of them, and the figure records how long each prefix is instead of
+    repeating the smaller complexes.
+
+    PARAMETERS
+    ----------
+    deltas: {list} (threshold, SimplicialComplex) tuples of the simplices
+            added at each threshold, e.g. from iter_complexes with delta=True
+
+    title: {str} title of the plot
+
+    names: {list} the name of each vertex
+
+    layout: {Layout} the coordinates of the vertices, defaults to laying out
+            the last complex
+
+    thresholds: {array} every threshold of the sweep, since iter_complexes
+                stops yielding deltas once nothing else is added, defaults to
+                the thresholds of the deltas
+
+    RETURNS
+    -------
+    fig: {plotly.graph_objs.Figure} the figure of the last complex, with
+         fig.layout.meta['filtration'] holding the thresholds and the number
+         of vertices, edges and faces of the complex at each one. The edge
+         trace holds three points per edge.
+    '''
+    deltas = list(deltas)
+    if thresholds is None:
+        thresholds = [p for p, delta in deltas]
+
+    k = max([delta.k for p, delta in deltas] or [0])
+    simplices = [np.concatenate([delta.dimension(dim) for p, delta in deltas]
+                                or [np.empty((0, dim+1), dtype=np.int32)])
+                 for dim in range(max(k, 2) + 1)]
+    final_complex = SimplicialComplex(simplices)
+
+    # The first row is the empty complex before any delta, and the
+    # complexes stop changing after the last delta
+    sizes = [[len(delta.dimension(dim)) for dim in range(3)]
+             for p, delta in deltas]
+    counts = np.cumsum([[0, 0, 0]] + sizes, axis=0)
+    counts = counts[np.searchsorted([p for p, delta in deltas], thresholds,
+                                    side='right')]
+
+    fig = visualize_complex(final_complex, title, names, layout)
+    fig.layout.meta = {'filtration': {
+        'thresholds': np.asarray(thresholds, dtype=float).tolist(),
+        'n_vertices': counts[:, 0].tolist(),
+        'n_edges': counts[:, 1].tolist(),
+        'n_faces': counts[:, 2].tolist()}}
 
     return fig
 
-client = pymongo.MongoClient()
 db_name = 'nfl'
-db = client[db_name]
 collection_name = 'complexes'
-COMPLEXES = db[collection_name]
-COMPLEXES.create_index([('name', pymongo.ASCENDING)], unique=True)
+_complexes = None
+
+def get_complexes():
+    '''
+    This function connects to MongoDB on first use and makes sure the figures
+    are indexed by name
+
+    RETURNS
+    -------
+    complexes: {pymongo.collection.Collection} the collection of figures
+    '''
+    global _complexes
+
+    if _complexes is None:
+        import pymongo
+
+        client = pymongo.MongoClient()
+        _complexes = client[db_name][collection_name]
+        _complexes.create_index([('name', pymongo.ASCENDING)], unique=True)
+
+    return _complexes
+
+def encode_figure(figure, name, compress=False):
+    '''
+    This function turns a figure into the document stored in MongoDB
+
+    PARAMETERS
+    ----------
+    figure: {plotly.graph_objs.Figure} the figure
+
+    name: {str} the name of the figure
+
+    compress: {bool} whether to zlib compress the numeric arrays of at least
+              COMPRESS_SIZE elements, which only decode_figure can read
+
+    RETURNS
+    -------
+    doc: {dict} the document, a plotly JSON dict unless compressed
+    '''
+    doc = encode_value(figure.to_plotly_json(), compress)
+    doc['name'] = name
+
+    return doc
+
+def decode_figure(doc, collection=None):
+    '''
+    This function turns a stored document back into a plotly JSON dict
+
+    PARAMETERS
+    ----------
+    doc: {dict} the document
+
+    collection: {pymongo.collection.Collection} the collection the document
+                came from, needed when it is stored in GridFS
+
+    RETURNS
+    -------
+    fig_json: {dict} the figure, with the compressed arrays as NumPy arrays
+    '''
+    if 'gridfs_id' in doc:
+        collection = collection if collection is not None else get_complexes()
+        doc = from_gridfs(doc, collection)
+
+    fig_json = decode_value({key: value for key, value in doc.items()
+                        if key not in ['_id', 'name']})
+
+    return fig_json
+
+class FigureWriter:
+
+    def __init__(self, collection=None, batch_size=100, replace=True,
+                 compress=False):
+        '''
+        The FigureWriter object buffers figures and writes them to MongoDB
+        with unordered bulk upserts keyed by name, so inserting the same
+        figures again is safe. The figures are stored as plotly JSON dicts
+        the web app reads directly, unless compress is True, and documents
+        too big for BSON go to GridFS. Flush it, or use it as a
+        context manager, to write the last batch. As a context manager it
+        also writes the figures buffered before an error.
+
+        PARAMETERS
+        ----------
+        collection: {pymongo.collection.Collection} where to write the
+                    figures, defaults to the complexes collection
+
+        batch_size: {int} the number of figures written per round-trip
+
+        replace: {bool} whether to replace figures that already exist, or
+                 skip them
+
+        compress: {bool} whether to zlib compress large numeric arrays, for
+                  collections that are only read through decode_figure
+        '''
+        self.collection = collection
+        self.batch_size = batch_size
+        self.replace = replace
+        self.compress = compress
+        self.written = 0
+        self.replaced = 0
+        self.skipped = 0
+        self._docs = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+            return False
+
+        # Keep the figures rendered before the error, then let it propagate
+        n_docs = len(self._docs)
+        try:
+            self.flush()
+        except Exception as e:
+            print("Discarded {} buffered figures: {!r}".format(n_docs, e),
+                  file=sys.stderr)
+
+        return False
+
+    def _collection(self):
+        if self.collection is None:
+            self.collection = get_complexes()
+
+        return self.collection
+
+    def write(self, figure, name):
+        '''
+        This method buffers a figure, writing the buffer once it is full
+
+        PARAMETERS
+        ----------
+        figure: {plotly.graph_objs.Figure} the figure
+
+        name: {str} the name of the figure
+        '''
+        # A later figure of the same name replaces an earlier one
+        self._docs.pop(name, None)
+        self._docs[name] = encode_figure(figure, name, self.compress)
+
+        if len(self._docs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        This method writes the buffered figures in one bulk write
+        '''
+        from pymongo import ReplaceOne, UpdateOne
+
+        if len(self._docs) == 0:
+            return
+
+        collection = self._collection()
+        docs = [to_gridfs(doc, collection) for doc in self._docs.values()]
+        self._docs = OrderedDict()
+
+        if self.replace:
+            # The GridFS files of the figures about to be replaced
+            old_files = gridfs_files(collection,
+                                      [doc['name'] for doc in docs])
+            requests = [ReplaceOne({'name': doc['name']}, doc, upsert=True)
+                        for doc in docs]
+        else:
+            requests = [UpdateOne({'name': doc['name']},
+                                  {'$setOnInsert': doc}, upsert=True)
+                        for doc in docs]
+
+        with metrics.stage('visualization_to_db', n_figures=len(docs)) as m:
+            result = collection.bulk_write(requests, ordered=False)
+
+            written = result.upserted_count
+            replaced = result.modified_count
+            skipped = len(docs) - written - replaced
+            m['written'], m['replaced'], m['skipped'] = \
+                written, replaced, skipped
+
+        self.written += written
+        self.replaced += replaced
+        self.skipped += skipped
+
+        # Remove the GridFS files no document points to anymore: those of
+        # replaced figures, or the new ones of skipped figures
+        if self.replace:
+            unused = old_files
+        else:
+            new_files = [doc['gridfs_id'] for doc in docs
+                         if 'gridfs_id' in doc]
+            used = {doc['gridfs_id'] for doc in
+                    collection.find({'gridfs_id': {'$in': new_files}},
+                                    {'gridfs_id': 1})}
+            unused = [file_id for file_id in new_files if file_id not in used]
+
+        delete_gridfs(collection, unused)
+
+    def stats(self):
+        '''
+        This method counts the figures written so far
+
+        RETURNS
+        -------
+        stats: {dict} the number of figures written new, replaced, and
+               skipped because they already existed unchanged or replace
+               is False
+        '''
+        return {'written': self.written, 'replaced': self.replaced,
+                'skipped': self.skipped}
 
 def visualization_to_db(figure, name):
-    fig_json = figure.to_plotly_json()
-    fig_json['name'] = name
-    COMPLEXES.insert_one(fig_json)
+    '''
+    This function writes a single figure to MongoDB, replacing any figure of
+    the same name. Use a FigureWriter to write many figures.
+
+    PARAMETERS
+    ----------
+    figure: {plotly.graph_objs.Figure} the figure
+
+    name: {str} the name of the figure
+    '''
+    with FigureWriter(batch_size=1) as writer:
+        writer.write(figure, name)
 
 if __name__ == '__main__':
-    from sklearn.cluster import AgglomerativeClustering
-    from sklearn.preprocessing import StandardScaler
-    from src.data_pipeline import engine, query_avg, query_week
-
-    positions = ['QB', 'RB', 'WR', 'TE', 'K', 'DEF', 'LB', 'DB', 'DL']
-    n_sets = [5, 12, 12, 11, 8, 7, 11, 7, 10]
-
-    for n, pos in zip(n_sets, positions):
-        df = query_week(week=1, year=2018, pos=pos)
-        df = df.iloc[:100]
-        names = list(df['name'].values)
-        X = df['weekpts'].values.reshape(-1,1)
-        agg = AgglomerativeClustering(n_clusters=n, linkage='ward')
-        labels = agg.fit_predict(X)
-
-        stats = df.iloc[:,4:].values
-
-        scaler = StandardScaler()
-        scaled_stats = scaler.fit_transform(stats)
-
-        cmapper = ClutchMapper()
-        cmapper.fit(scaled_stats, labels)
-
-        for i in np.arange(0,10.1,0.5):
-            observer_complex, landmark_complex = cmapper.build_complex(i)
-
-            observer_fig = visualize_complex(
-                               observer_complex,
-                               '2018 {} Week 1: Observer Complex at t={}'.\
-                                       format(pos, i)
-                               )
-            landmark_fig = visualize_complex(
-                               landmark_complex,
-                               '2018 {} Week 1: Landmark Complex at t={}'.\
-                                       format(pos, i), names
-                               )
-
-            visualization_to_db(observer_fig,
-                '{}_week_1_observer_complex_{}_2018'.format(pos.lower(), i))
-            visualization_to_db(landmark_fig,
-                '{}_week_1_landmark_complex_{}_2018'.format(pos.lower(), i))
-
-        print("Got {} data for 2018 week 1".format(pos))
-
-    # for n, pos in zip(n_sets, positions):
-        for week in range(1,18):
-            df = query_week(week=week, pos=pos)
-            df = df.iloc[:100]
-            names = list(df['name'].values)
-            X = df['weekpts'].values.reshape(-1,1)
-            agg = AgglomerativeClustering(n_clusters=n, linkage='ward')
-            labels = agg.fit_predict(X)
-
-            stats = df.iloc[:,4:].values
-
-            scaler = StandardScaler()
-            scaled_stats = scaler.fit_transform(stats)
-
-            cmapper = ClutchMapper()
-            cmapper.fit(scaled_stats, labels)
-
-            for i in np.arange(0,10.1,0.5):
-                observer_complex, landmark_complex = cmapper.build_complex(i)
-
-                observer_fig = visualize_complex(
-                                   observer_complex,
-                                   '2017 {} Week {}: Observer Complex at t={}'.\
-                                        format(pos, week, i)
-                                   )
-                landmark_fig = visualize_complex(
-                                   landmark_complex,
-                                   '2017 {} Week {}: Landmark Complex at t={}'.\
-                                        format(pos, week, i), names
-                                   )
-
-                visualization_to_db(observer_fig,
-                    '{}_week_{}_observer_complex_{}_2017'.\
-                            format(pos.lower(), week, i))
-                visualization_to_db(landmark_fig, 
-                    '{}_week_{}_landmark_complex_{}_2017'.\
-                            format(pos.lower(), week, i))
-
-            print("Got {} data for 2017 week {}".format(pos,week))
-
-        df = query_avg(pos)
-        df = df.iloc[:100]
-        names = list(df['name'].values)
-        X = df['avg_points'].values.reshape(-1,1)
-        agg = AgglomerativeClustering(n_clusters=n, linkage='ward')
-        labels = agg.fit_predict(X)
-
-        stats = df.iloc[:,4:].values
-
-        scaler = StandardScaler()
-        scaled_stats = scaler.fit_transform(stats)
-
-        cmapper = ClutchMapper()
-        cmapper.fit(scaled_stats, labels)
-
-        for i in np.arange(0,10.1,0.5):
-            observer_complex, landmark_complex = cmapper.build_complex(i)
-
-            observer_fig = visualize_complex(
-                               observer_complex,
-                               '2017 {} AVG: Observer Complex at t={}'.\
-                                   format(pos, i)
-                               )
-            landmark_fig = visualize_complex(
-                               landmark_complex,
-                               '2017 {} AVG: Landmark Complex at t={}'.\
-                                   format(pos, i), names
-                               )
-
-            visualization_to_db(observer_fig,
-                '{}_avg_observer_complex_{}_2017'.format(pos.lower(), i))
-            visualization_to_db(landmark_fig,
-                '{}_avg_landmark_complex_{}_2017'.format(pos.lower(), i))
-
-        print("Got all {} complexes!".format(pos))
+    from src.pipeline import POSITIONS, Job, PipelineRunner
+
+    # For each position, 2018 week 1, then every week of 2017 and its averages
+    weeks = [(2018, 1)] + [(2017, week) for week in range(1,18)] + \
+            [(2017, 'avg')]
+    jobs = [Job(year, week, pos) for pos in POSITIONS for year, week in weeks]
+
+    PipelineRunner(jobs).run()